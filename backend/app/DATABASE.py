@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Boolean, Index, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime, Text, Boolean, Index, UniqueConstraint, event, func, select, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .db import Base
@@ -14,40 +14,60 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-    videos = relationship("Video", back_populates="author", cascade="all, delete-orphan")
-    comments = relationship("Comment", back_populates="author", cascade="all, delete-orphan")
-    watch_history = relationship("WatchHistory", back_populates="user", cascade="all, delete-orphan")
+    # passive_deletes: дочерние строки удаляет сама БД по ON DELETE CASCADE, а не сессия по одной.
+    # Счётчики comments_count у чужих видео поправляет _user_deleting ниже, одним UPDATE
+    videos = relationship("Video", back_populates="author", cascade="all, delete-orphan", passive_deletes=True)
+    comments = relationship("Comment", back_populates="author", cascade="all, delete-orphan", passive_deletes=True)
+    watch_history = relationship("WatchHistory", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
     chats_as_user1 = relationship("Chat", foreign_keys="Chat.user1_id", back_populates="user1",
-                                  cascade="all, delete-orphan")
+                                  cascade="all, delete-orphan", passive_deletes=True)
     chats_as_user2 = relationship("Chat", foreign_keys="Chat.user2_id", back_populates="user2",
-                                  cascade="all, delete-orphan")
-    letters = relationship("Letter", back_populates="author", cascade="all, delete-orphan")
+                                  cascade="all, delete-orphan", passive_deletes=True)
+    letters = relationship("Letter", back_populates="author", cascade="all, delete-orphan", passive_deletes=True)
+    tokens = relationship("Token", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
 
 class Video(Base):
     __tablename__ = "videos"
+    __table_args__ = (
+        # Индексы под keyset-пагинацию каталога: (ключ сортировки, id)
+        Index('idx_video_created_id', 'created_at', 'id'),
+        Index('idx_video_views_id', 'views_count', 'id'),
+        Index('idx_video_title_id', 'title', 'id'),
+        # Дедупликация импорта: одна ссылка (после нормализации) на автора
+        UniqueConstraint('author_id', 'url_hash', name='unique_video_author_url'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     uuid = Column(String, unique=True, index=True, nullable=False)  # UUID для публичных ссылок
     title = Column(String, nullable=False)
     description = Column(Text)
     video_url = Column(String, nullable=False)  # URL или путь к видео
+    url_hash = Column(String(64))  # sha256 нормализованного video_url у импортированных видео, см. importer.url_hash
     thumbnail_url = Column(String)  # Превью
     duration = Column(Integer)  # Длительность в секундах
     author_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    file_id = Column(Integer, ForeignKey("stored_files.id", ondelete="SET NULL"), index=True)  # загруженный файл
     views_count = Column(Integer, default=0)
     likes_count = Column(Integer, default=0)
+    comments_count = Column(Integer, default=0, nullable=False)  # поддерживается событиями Comment ниже
+    processing_status = Column(String(16))  # pending / processing / ready / failed; None — не обрабатывалось
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     author = relationship("User", back_populates="videos")
-    comments = relationship("Comment", back_populates="video", cascade="all, delete-orphan")
-    watch_history = relationship("WatchHistory", back_populates="video")
+    file = relationship("StoredFile")
+    comments = relationship("Comment", back_populates="video", cascade="all, delete-orphan", passive_deletes=True)
+    watch_history = relationship("WatchHistory", back_populates="video", passive_deletes=True)
 
 
 class Comment(Base):
     __tablename__ = "comments"
+    __table_args__ = (
+        # Список комментариев видео и каскадное удаление вместе с видео
+        Index('idx_comment_video_created', 'video_id', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     uuid = Column(String, unique=True, index=True, nullable=False)
@@ -62,10 +82,49 @@ class Comment(Base):
     author = relationship("User", back_populates="comments")
 
 
+# Счётчик комментариев меняется в той же транзакции, что и сама запись comments.
+# Срабатывает для create_comment/delete_comment и для комментариев, загруженных в сессию.
+@event.listens_for(Comment, "after_insert")
+def _comment_inserted(mapper, connection, target):
+    connection.execute(
+        Video.__table__.update()
+        .where(Video.id == target.video_id)
+        .values(comments_count=Video.comments_count + 1)
+    )
+
+
+@event.listens_for(Comment, "after_delete")
+def _comment_deleted(mapper, connection, target):
+    connection.execute(
+        Video.__table__.update()
+        .where(Video.id == target.video_id)
+        .values(comments_count=Video.comments_count - 1)
+    )
+
+
+@event.listens_for(User, "before_delete")
+def _user_deleting(mapper, connection, target):
+    # Остальные комментарии пользователя удалит ON DELETE CASCADE мимо after_delete —
+    # вычитаем их из счётчиков заранее, по строке на видео, а не по комментарию
+    authored = (
+        select(Comment.video_id, func.count().label("n"))
+        .where(Comment.author_id == target.id)
+        .group_by(Comment.video_id)
+        .subquery()
+    )
+    connection.execute(
+        Video.__table__.update()
+        .where(Video.id == authored.c.video_id)
+        .values(comments_count=Video.comments_count - authored.c.n)
+    )
+
+
 class WatchHistory(Base):
     __tablename__ = "watch_history"
     __table_args__ = (
-        Index('idx_watch_history_user_video', 'user_id', 'video_id'),
+        # Уникальность нужна для upsert и защищает от дублей при параллельных heartbeat
+        UniqueConstraint('user_id', 'video_id', name='unique_watch_user_video'),
+        Index('idx_watch_video', 'video_id'),  # для ON DELETE CASCADE при удалении видео
     )
 
     id = Column(Integer, primary_key=True, index=True)
@@ -81,9 +140,18 @@ class WatchHistory(Base):
 
 class Token(Base):
     __tablename__ = "tokens"
+    __table_args__ = (
+        Index('idx_token_expires', 'expires_at'),
+        # Отозванные access-токены для purge_tokens — частичный индекс, в нём только они.
+        # Условие записано так же, как его рендерит запрос в каждой СУБД, иначе индекс не подойдёт
+        Index('idx_token_revoked_access', 'id',
+              postgresql_where=text("is_revoked AND token_type = 'access'"),
+              sqlite_where=text("is_revoked = 1 AND token_type = 'access'")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    token = Column(String, unique=True, index=True, nullable=False)
+    jti = Column(String(32), unique=True, index=True, nullable=False)  # короткий id токена из JWT
+    family_id = Column(String(32), index=True, nullable=False)  # все токены одного входа и его refresh-цепочки
     token_type = Column(String, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     expires_at = Column(DateTime, nullable=False)
@@ -109,7 +177,9 @@ class Chat(Base):
 
     user1 = relationship("User", foreign_keys=[user1_id], back_populates="chats_as_user1")
     user2 = relationship("User", foreign_keys=[user2_id], back_populates="chats_as_user2")
-    letters = relationship("Letter", back_populates="chat", cascade="all, delete-orphan", order_by="Letter.created_at")
+    letters = relationship("Letter", back_populates="chat", cascade="all, delete-orphan",
+                           passive_deletes=True, order_by="Letter.created_at")
+    summaries = relationship("ChatSummary", back_populates="chat", cascade="all, delete-orphan", passive_deletes=True)
 
     @property
     def last_letter(self):
@@ -122,14 +192,96 @@ class Letter(Base):
     __tablename__ = "letters"
     __table_args__ = (
         Index('idx_letter_chat_created', 'chat_id', 'created_at'),
+        # Отметка прочтения в chat_summaries сравнивает id, поэтому id не должны повторяться:
+        # без AUTOINCREMENT SQLite отдаёт id удалённого последнего письма следующему
+        {"sqlite_autoincrement": True},
     )
 
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
     author_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     content = Column(Text, nullable=False)
-    is_read = Column(Boolean, default=False)  # прочитано ли сообщение
+    # Устарело: прочитанность считается по chat_summaries.last_read_letter_id,
+    # колонка читается только при пересборке сводок из старых данных
+    is_read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     chat = relationship("Chat", back_populates="letters")
     author = relationship("User", back_populates="letters")
+
+
+class ChatSummary(Base):
+    """Строка входящих для каждого участника чата: последнее письмо, отметка прочтения и число непрочитанных."""
+    __tablename__ = "chat_summaries"
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'user_id', name='unique_chat_summary'),
+        Index('idx_chat_summary_inbox', 'user_id', 'updated_at'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    last_letter_id = Column(Integer)  # без FK: строка обновляется в той же транзакции, что и letters
+    last_letter_preview = Column(String(200))
+    last_letter_at = Column(DateTime)
+    last_read_letter_id = Column(Integer)  # всё до этого id включительно участник прочитал
+    unread_count = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    chat = relationship("Chat", back_populates="summaries")
+
+
+class StoredFile(Base):
+    """Файл на диске. Одинаковое содержимое хранится один раз — ключ sha256."""
+    __tablename__ = "stored_files"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), unique=True, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class UploadSession(Base):
+    """Возобновляемая загрузка: байты до offset уже записаны на диск и подтверждены."""
+    __tablename__ = "upload_sessions"
+    __table_args__ = (
+        Index('idx_upload_user_status', 'user_id', 'status'),
+        Index('idx_upload_updated', 'updated_at'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    uuid = Column(String, unique=True, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    filename = Column(String, nullable=False)
+    content_type = Column(String)
+    size = Column(BigInteger, nullable=False)  # заявленный размер файла
+    offset = Column(BigInteger, default=0, nullable=False)
+    sha256 = Column(String(64))  # ожидаемый хэш, если клиент его прислал
+    status = Column(String(16), default="uploading", nullable=False)  # uploading / completed
+    file_id = Column(Integer, ForeignKey("stored_files.id", ondelete="SET NULL"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    file = relationship("StoredFile")
+
+
+class Job(Base):
+    """Фоновая задача по видео. Очередь живёт в БД, выполняет её python -m app.manage worker."""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index('idx_job_ready', 'status', 'run_after'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(32), nullable=False)
+    video_id = Column(Integer, ForeignKey("videos.id", ondelete="CASCADE"), nullable=False, index=True)
+    status = Column(String(16), default="queued", nullable=False)  # queued / running / done / failed
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    run_after = Column(DateTime, default=datetime.utcnow, nullable=False)
+    locked_by = Column(String(64))
+    locked_at = Column(DateTime)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
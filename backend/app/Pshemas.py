@@ -31,7 +31,8 @@ class UserResponse(BaseModel):
 
 # ---------- Token Schemas ----------
 class TokenBase(BaseModel):
-    token: str
+    jti: str
+    family_id: str
     token_type: str
 
 
@@ -77,6 +78,15 @@ class WatchHistoryCreate(BaseModel):
     completed: bool = False
 
 
+class WatchBatchCreate(BaseModel):
+    events: List[WatchHistoryCreate] = Field(..., min_length=1, max_length=500)
+
+
+class WatchBatchResponse(BaseModel):
+    accepted: int
+    skipped_video_ids: List[int] = []
+
+
 class WatchHistoryResponse(BaseModel):
     id: int
     video_id: int
@@ -101,6 +111,15 @@ class VideoCreate(VideoBase):
     pass
 
 
+class VideoUpload(BaseModel):
+    """Видео из файла, загруженного через /api/uploads."""
+    file_id: int
+    title: str = Field(..., min_length=1, max_length=200)
+    description: Optional[str] = Field(None, max_length=5000)
+    thumbnail_url: Optional[str] = None
+    duration: Optional[int] = Field(None, ge=0)
+
+
 class VideoUpdate(BaseModel):
     title: Optional[str] = Field(None, min_length=1, max_length=200)
     description: Optional[str] = Field(None, max_length=5000)
@@ -119,6 +138,8 @@ class VideoResponse(VideoBase):
     created_at: datetime
     updated_at: datetime
     comments_count: int = 0
+    # pending / processing / ready / failed; None у видео, добавленных до фоновой обработки
+    processing_status: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -135,6 +156,34 @@ class VideoListResponse(BaseModel):
     comments_count: int = 0
 
 
+# ---------- Upload Schemas ----------
+class UploadCreate(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    size: int = Field(..., gt=0)
+    content_type: Optional[str] = Field(None, max_length=100)
+    sha256: Optional[str] = Field(None, pattern=r"^[0-9a-f]{64}$")  # если известен — проверим и, возможно, не придётся грузить
+
+
+class StoredFileResponse(BaseModel):
+    id: int
+    sha256: str
+    size: int
+    content_type: Optional[str] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class UploadSessionResponse(BaseModel):
+    id: str
+    filename: str
+    size: int
+    offset: int
+    status: str
+    file: Optional[StoredFileResponse] = None
+    created_at: datetime
+    updated_at: datetime
+
+
 # ---------- Comment Schemas ----------
 class CommentBase(BaseModel):
     content: str = Field(..., min_length=1, max_length=2000)
@@ -204,12 +253,31 @@ class ChatResponse(BaseModel):
     created_at: datetime
     updated_at: datetime
     last_letter: Optional[LetterResponse] = None
+    last_letter_preview: Optional[str] = None
     unread_count: int = 0
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class LetterSearchResult(BaseModel):
+    id: int
+    chat_id: int
+    author_id: int
+    author: UserMinimal
+    snippet: str  # HTML: текст экранирован, совпадения в <mark>
+    created_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ChatReadResponse(BaseModel):
+    chat_id: int
+    last_read_letter_id: Optional[int] = None
+    unread_count: int
+
+
 class ChatDetailResponse(ChatResponse):
-    letters: List[LetterResponse] = []
+    letters: List[LetterResponse] = []  # последняя страница, от старых к новым
+    next_before_id: Optional[int] = None  # есть более старые письма
 
 
@@ -1,17 +1,21 @@
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
 import os
 from dotenv import load_dotenv
 import secrets
 
-from . import DATABASE, Pshemas
-from .db import get_db
+from . import DATABASE, Pshemas, timing
+from .db import get_async_db, read_primary, SessionLocal
+from .cache import LRUCache
+from .hashing import password_executor
 
 load_dotenv()
 
@@ -19,114 +23,258 @@ SECRET_KEY = os.getenv("ILOVELEGUEOFLEGEND", secrets.token_urlsafe(32))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
+# Между воркерами отзыв токена виден не позже, чем через этот TTL
+TOKEN_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "30"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+# Как часто удалять истёкшие и отозванные токены (0 — только вручную: python -m app.manage purge-tokens)
+TOKEN_PURGE_INTERVAL_SECONDS = float(os.getenv("TOKEN_PURGE_INTERVAL_SECONDS", "3600"))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 security = HTTPBearer()
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+@dataclass(frozen=True)
+class CurrentUser:
+    """Лёгкая замена ORM-объекта User для авторизованных запросов — её можно держать в кэше."""
+    id: int
+    email: str
+    username: str
+    is_active: bool
+    created_at: datetime
 
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+# Кэш проверенных токенов: jti -> CurrentUser с тегом пользователя. Отдельного состояния
+# на пользователя нет — всё живёт в записях кэша и вытесняется вместе с ними
+token_cache = LRUCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS)
 
 
-def authenticate_user(db: Session, email: str, password: str) -> Optional[DATABASE.User]:
-    user = db.query(DATABASE.User).filter(DATABASE.User.email == email).first()
-    if not user or not verify_password(password, user.hashed_password):
+def _user_tokens_tag(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def forget_cached_tokens(user_id: int) -> None:
+    # Все закэшированные токены пользователя перестают приниматься без проверки в БД
+    token_cache.invalidate(_user_tokens_tag(user_id))
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    # bcrypt выполняется в отдельном ограниченном пуле, а обработчик ждёт его в event loop, не занимая поток сервера
+    return await password_executor.arun("verify", pwd_context.verify, plain_password, hashed_password)
+
+
+async def get_password_hash(password: str) -> str:
+    return await password_executor.arun("hash", pwd_context.hash, password)
+
+
+def _login_candidate(db: Session, email: str):
+    user = db.query(
+        DATABASE.User.id, DATABASE.User.hashed_password, DATABASE.User.is_active
+    ).filter(DATABASE.User.email == email).first()
+    # Не держим соединение из пула, пока идёт bcrypt
+    db.rollback()
+    return user
+
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    """(id, hashed_password, is_active) пользователя или None, если email или пароль не подходят."""
+    user = await db.run_sync(_login_candidate, email)
+    if not user or not await verify_password(password, user.hashed_password):
         return None
     return user
 
 
-def create_access_token(data: dict) -> Tuple[str, datetime]:
+def new_token_id() -> str:
+    return secrets.token_urlsafe(12)
+
+
+def _create_token(data: dict, token_type: str, family_id: str, expires_at: datetime) -> Tuple[str, str, datetime]:
+    # jti — короткий идентификатор сессии в БД, fam — семейство токенов одного входа
+    jti = new_token_id()
     to_encode = data.copy()
-    expires_at = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expires_at, "type": "access"})
+    to_encode.update({"exp": expires_at, "type": token_type, "jti": jti, "fam": family_id})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt, expires_at
+    return encoded_jwt, jti, expires_at
 
 
-def create_refresh_token(data: dict) -> Tuple[str, datetime]:
-    to_encode = data.copy()
+def create_access_token(data: dict, family_id: str) -> Tuple[str, str, datetime]:
+    expires_at = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return _create_token(data, "access", family_id, expires_at)
+
+
+def create_refresh_token(data: dict, family_id: str) -> Tuple[str, str, datetime]:
     expires_at = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expires_at, "type": "refresh"})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt, expires_at
+    return _create_token(data, "refresh", family_id, expires_at)
 
 
-def save_token(db: Session, token: str, token_type: str, user_id: int, expires_at: datetime) -> DATABASE.Token:
+def save_token(db: Session, jti: str, family_id: str, token_type: str, user_id: int,
+               expires_at: datetime) -> DATABASE.Token:
     db_token = DATABASE.Token(
-        token=token,
+        jti=jti,
+        family_id=family_id,
         token_type=token_type,
         user_id=user_id,
         expires_at=expires_at
     )
     db.add(db_token)
-    db.commit()
-    db.refresh(db_token)
     return db_token
 
 
+def issue_token_pair(db: Session, user_id: int, family_id: Optional[str] = None) -> dict:
+    family_id = family_id or new_token_id()
+
+    access_token, access_jti, access_expires = create_access_token({"sub": str(user_id)}, family_id)
+    refresh_token, refresh_jti, refresh_expires = create_refresh_token({"sub": str(user_id)}, family_id)
+
+    save_token(db, access_jti, family_id, "access", user_id, access_expires)
+    save_token(db, refresh_jti, family_id, "refresh", user_id, refresh_expires)
+    db.commit()
+
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer"
+    }
+
+
+def revoke_family(db: Session, family_id: str, user_id: int) -> None:
+    # Один UPDATE на всё семейство вместо обхода ORM-объектов
+    db.query(DATABASE.Token).filter(
+        DATABASE.Token.family_id == family_id,
+        DATABASE.Token.is_revoked == False
+    ).update({"is_revoked": True}, synchronize_session=False)
+    db.commit()
+    forget_cached_tokens(user_id)
+
+
 def revoke_token(db: Session, token: str) -> None:
-    db_token = db.query(DATABASE.Token).filter(DATABASE.Token.token == token).first()
-    if db_token:
-        db_token.is_revoked = True
-        db.commit()
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False})
+        family_id = payload["fam"]
+        user_id = int(payload["sub"])
+    except (JWTError, KeyError, ValueError):
+        return
+    revoke_family(db, family_id, user_id)
 
 
 def revoke_all_user_tokens(db: Session, user_id: int) -> None:
     db.query(DATABASE.Token).filter(
-        DATABASE.Token.user_id == user_id
-    ).update({"is_revoked": True})
+        DATABASE.Token.user_id == user_id,
+        DATABASE.Token.is_revoked == False
+    ).update({"is_revoked": True}, synchronize_session=False)
     db.commit()
+    forget_cached_tokens(user_id)
 
 
-async def get_current_user(
-        credentials: HTTPAuthorizationCredentials = Depends(security),
-        db: Session = Depends(get_db)
-) -> DATABASE.User:
-    token = credentials.credentials
-
-    db_token = db.query(DATABASE.Token).filter(
-        and_(
-            DATABASE.Token.token == token,
-            DATABASE.Token.is_revoked == False
-        )
-    ).first()
-
-    if not db_token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token not found or revoked",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+def purge_tokens(db: Session, batch_size: int = 1000) -> int:
+    """Удаляет истёкшие токены и отозванные access-токены пачками, чтобы не держать долгих блокировок.
+
+    Отозванные refresh-токены живут до истечения: по ним ловится повторное использование.
+    Условия удаляются по очереди, а не через OR: каждое идёт по своему индексу,
+    и очередная пачка не сканирует всю таблицу заново.
+    """
+    now = datetime.utcnow()
+    expired = DATABASE.Token.expires_at < now
+    revoked_access = and_(DATABASE.Token.is_revoked == True, DATABASE.Token.token_type == "access")
+    return _delete_tokens(db, expired, batch_size) + _delete_tokens(db, revoked_access, batch_size)
+
+
+def _delete_tokens(db: Session, condition, batch_size: int) -> int:
+    deleted = 0
+    while True:
+        ids = [token_id for (token_id,) in db.query(DATABASE.Token.id).filter(condition).limit(batch_size).all()]
+        if not ids:
+            return deleted
+        db.query(DATABASE.Token).filter(DATABASE.Token.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            return deleted
+
 
+def purge_tokens_job() -> None:
+    db = SessionLocal()
+    try:
+        purge_tokens(db)
+    finally:
+        db.close()
+
+
+def _credentials_error(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def decode_access_token(token: str) -> Tuple[int, str, datetime]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         token_type: str = payload.get("type")
+        jti: str = payload.get("jti")
 
-        if user_id is None or token_type != "access":
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token type",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
+        if user_id is None or jti is None or token_type != "access":
+            raise _credentials_error("Invalid token type")
     except JWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+        raise _credentials_error("Could not validate credentials")
+
+    return int(user_id), jti, datetime.utcfromtimestamp(payload["exp"])
 
-    user = db.query(DATABASE.User).filter(DATABASE.User.id == int(user_id)).first()
+
+def load_current_user(db: Session, jti: str, user_id: int) -> CurrentUser:
+    # Токен выдают вход и refresh — запросы без Authorization, и "липкость" к основной БД
+    # их не касается: на реплике свежего токена (и нового пользователя) может ещё не быть
+    with read_primary(db):
+        db_token = db.query(DATABASE.Token).filter(
+            and_(
+                DATABASE.Token.jti == jti,
+                DATABASE.Token.is_revoked == False
+            )
+        ).first()
+
+        if not db_token:
+            raise _credentials_error("Token not found or revoked")
+
+        user = db.query(DATABASE.User).filter(DATABASE.User.id == user_id).first()
     if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+        raise _credentials_error("User not found")
+
+    return CurrentUser(
+        id=user.id,
+        email=user.email,
+        username=user.username,
+        is_active=user.is_active,
+        created_at=user.created_at
+    )
+
+
+def _verify_and_cache(db: Session, jti: str, user_id: int, expires_at: datetime) -> CurrentUser:
+    # Версию кэша берём до чтения из БД: если отзыв случится во время проверки, set ничего не запишет
+    version = token_cache.version
+    current_user = load_current_user(db, jti, user_id)
+    ttl = min(TOKEN_CACHE_TTL_SECONDS, (expires_at - datetime.utcnow()).total_seconds())
+    if ttl > 0:
+        token_cache.set(jti, current_user, tags=(_user_tokens_tag(user_id),), ttl=ttl, version=version)
+    return current_user
+
+
+def verify_access_token(db: Session, token: str) -> CurrentUser:
+    user_id, jti, expires_at = decode_access_token(token)
+    return token_cache.get(jti) or _verify_and_cache(db, jti, user_id, expires_at)
+
+
+async def get_current_user(
+        credentials: HTTPAuthorizationCredentials = Depends(security),
+        db: AsyncSession = Depends(get_async_db)
+) -> CurrentUser:
+    with timing.phase("auth"):
+        user_id, jti, expires_at = decode_access_token(credentials.credentials)
+
+        # Попадание в кэш обходится без БД и без переключения в пул потоков
+        current_user = token_cache.get(jti)
+        if current_user is not None:
+            return current_user
 
-    return user
\ No newline at end of file
+        return await db.run_sync(_verify_and_cache, jti, user_id, expires_at)
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "30"))
+# Сколько первых страниц каталога прогреть при старте (0 — не прогревать)
+RESPONSE_CACHE_WARMUP_PAGES = int(os.getenv("RESPONSE_CACHE_WARMUP_PAGES", "0"))
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с TTL, ограничением по размеру и тегами для точечной инвалидации."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.version = 0  # растёт при каждой инвалидации
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._tags: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = (), ttl: Optional[float] = None,
+            version: Optional[int] = None) -> None:
+        """version — значение self.version до чтения из БД: если с тех пор была инвалидация, значение устарело."""
+        tags = tuple(tags)
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def invalidate(self, *tags: str) -> None:
+        with self._lock:
+            self.version += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class CachedResponse:
+    """Уже сериализованное JSON-тело со строгим ETag и дополнительными заголовками."""
+
+    def __init__(self, adapter: TypeAdapter, content: Any, headers: Optional[Dict[str, str]] = None):
+        # Как и response_model в FastAPI: сначала валидация, затем сериализация
+        self.body = adapter.dump_json(adapter.validate_python(content, from_attributes=True))
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        self.headers = dict(headers or {})
+        self.headers["ETag"] = self.etag
+        self.headers["Cache-Control"] = "no-cache"
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def cached_response(request: Request, entry: CachedResponse) -> Response:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, entry.etag):
+        return Response(status_code=304, headers=entry.headers)
+    return Response(content=entry.body, media_type="application/json", headers=entry.headers)
+
+
+# Теги: каталог целиком и отдельная карточка видео
+CATALOG_TAG = "video:catalog"
+
+
+def video_tag(video_id: int) -> str:
+    return f"video:{video_id}"
+
+
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS)
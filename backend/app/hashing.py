@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+from fastapi import HTTPException, status
+
+# bcrypt отпускает GIL, поэтому потоков достаточно — отдельные процессы не нужны
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Сколько операций может ждать в очереди сверх занятых потоков, дальше — 503
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "16"))
+
+
+class OperationStats:
+    def __init__(self):
+        self.count = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.total_wait_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "rejected": self.rejected,
+            "avg_ms": self.total_seconds / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max_seconds * 1000,
+            "avg_wait_ms": self.total_wait_seconds / self.count * 1000 if self.count else 0.0,
+        }
+
+
+class BoundedExecutor:
+    """Отдельный пул для тяжёлых CPU-операций с ограниченной очередью.
+
+    Запрос ждёт результат в event loop (arun) и потоков общего пула FastAPI не занимает.
+    Очередь всё равно ограничена: больше workers + queue_limit операций одновременно здесь
+    не окажется, остальные сразу получают 503, а не ждут секундами за чужими bcrypt.
+    """
+
+    def __init__(self, name: str, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._stats: Dict[str, OperationStats] = {}
+
+    def _operation(self, name: str) -> OperationStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats.setdefault(name, OperationStats())
+        return stats
+
+    def _submit(self, operation: str, func: Callable, *args):
+        stats = self._operation(operation)
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                stats.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, try again later",
+                headers={"Retry-After": "1"},
+            )
+
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self._in_flight += 1
+
+        def run():
+            started_at = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                finished_at = time.perf_counter()
+                with self._lock:
+                    self._in_flight -= 1
+                    stats.count += 1
+                    stats.total_wait_seconds += started_at - submitted_at
+                    stats.total_seconds += finished_at - started_at
+                    stats.max_seconds = max(stats.max_seconds, finished_at - started_at)
+                self._slots.release()
+
+        try:
+            return self._executor.submit(run)
+        except BaseException:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+            raise
+
+    async def arun(self, operation: str, func: Callable, *args):
+        return await asyncio.wrap_future(self._submit(operation, func, *args))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": self._in_flight,
+                "operations": {name: stats.as_dict() for name, stats in self._stats.items()},
+            }
+
+
+password_executor = BoundedExecutor("password-hash", PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_LIMIT)
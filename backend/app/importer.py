@@ -0,0 +1,163 @@
+"""Массовый импорт видео по ссылкам из NDJSON: одна строка — один Pshemas.VideoCreate.
+
+Строки читаются из потока по мере поступления и вставляются пачками по BULK_IMPORT_BATCH_SIZE,
+поэтому память не зависит от размера файла. Повтор ссылки у того же автора пропускается
+по уникальному индексу (author_id, url_hash).
+"""
+import hashlib
+import os
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from . import DATABASE, Pshemas
+from .jobs import enqueue_many
+
+BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "500"))
+# Строка длиннее считается ошибочной и пропускается целиком, не накапливаясь в памяти
+BULK_IMPORT_MAX_LINE_BYTES = int(os.getenv("BULK_IMPORT_MAX_LINE_BYTES", str(64 * 1024)))
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """Приводит ссылку к одному виду: регистр схемы и хоста, порт по умолчанию, порядок параметров, без #фрагмента."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        return url.strip()
+
+    host = parts.hostname or ""
+    if ":" in host:
+        host = f"[{host}]"
+    if port is not None and DEFAULT_PORTS.get(scheme) != port:
+        host = f"{host}:{port}"
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        host = f"{userinfo}@{host}"
+
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+
+async def ndjson_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Optional[bytes]]:
+    """Строки из потока байтов. Вместо слишком длинной строки отдаёт None."""
+    buffer = b""
+    oversized = False
+    async for chunk in chunks:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if oversized or len(line) > BULK_IMPORT_MAX_LINE_BYTES:
+                oversized = False
+                yield None
+            else:
+                yield line
+        if len(buffer) > BULK_IMPORT_MAX_LINE_BYTES:
+            buffer = b""
+            oversized = True
+    if oversized:
+        yield None
+    elif buffer:
+        yield buffer
+
+
+def insert_batch(db: Session, author_id: int, rows: List[Tuple[int, Pshemas.VideoCreate]]) -> List[dict]:
+    """Вставляет пачку одним INSERT ... ON CONFLICT DO NOTHING и ставит новые видео в очередь обработки.
+
+    Возвращает результат по каждой строке: created (с id и uuid) или duplicate.
+    """
+    now = datetime.utcnow()
+    results = []
+    lines = {}
+    values = []
+    for line, item in rows:
+        digest = url_hash(item.video_url)
+        if digest in lines:
+            # Повтор внутри самой пачки: в одном INSERT ON CONFLICT его не отсечёт
+            results.append({"line": line, "status": "duplicate"})
+            continue
+        lines[digest] = line
+        values.append({
+            "uuid": str(uuid.uuid4()),
+            "title": item.title,
+            "description": item.description,
+            "video_url": item.video_url,
+            "url_hash": digest,
+            "thumbnail_url": item.thumbnail_url,
+            "duration": item.duration,
+            "author_id": author_id,
+            "views_count": 0,
+            "likes_count": 0,
+            "comments_count": 0,
+            "processing_status": "pending",
+            "created_at": now,
+            "updated_at": now,
+        })
+
+    if values:
+        dialect = db.get_bind().dialect.name
+        insert = postgresql_insert if dialect == "postgresql" else sqlite_insert
+        statement = insert(DATABASE.Video.__table__).on_conflict_do_nothing(
+            index_elements=["author_id", "url_hash"]
+        ).returning(DATABASE.Video.id, DATABASE.Video.uuid, DATABASE.Video.url_hash)
+        created = {digest: (video_id, video_uuid) for video_id, video_uuid, digest in db.execute(statement, values)}
+
+        enqueue_many(db, [video_id for video_id, _ in created.values()])
+        db.commit()
+
+        for digest, line in lines.items():
+            if digest in created:
+                video_id, video_uuid = created[digest]
+                results.append({"line": line, "status": "created", "id": video_id, "uuid": video_uuid})
+            else:
+                results.append({"line": line, "status": "duplicate"})
+
+    results.sort(key=lambda result: result["line"])
+    return results
+
+
+def backfill_url_hashes(db: Session, batch_size: int = 1000) -> int:
+    """Проставляет url_hash видео, импортированным до появления колонки. Загруженные файлы не трогает.
+
+    Если у автора ссылка уже повторяется, хэш получает только первое видео: остальные
+    остаются без него и в дедупликации не участвуют.
+    """
+    max_id = db.query(func.max(DATABASE.Video.id)).scalar() or 0
+    filled = 0
+    for start in range(1, max_id + 1, batch_size):
+        rows = db.query(DATABASE.Video.id, DATABASE.Video.author_id, DATABASE.Video.video_url).filter(
+            DATABASE.Video.id.between(start, start + batch_size - 1),
+            DATABASE.Video.url_hash.is_(None),
+            DATABASE.Video.file_id.is_(None)
+        ).order_by(DATABASE.Video.id).all()
+        if not rows:
+            continue
+
+        hashes = {video_id: (author_id, url_hash(video_url)) for video_id, author_id, video_url in rows}
+        taken = set(db.query(DATABASE.Video.author_id, DATABASE.Video.url_hash).filter(
+            DATABASE.Video.url_hash.in_([digest for _, digest in hashes.values()])
+        ).all())
+
+        updates = []
+        for video_id, key in hashes.items():
+            if key not in taken:
+                taken.add(key)
+                updates.append({"id": video_id, "url_hash": key[1]})
+        if updates:
+            db.execute(update(DATABASE.Video), updates)
+        db.commit()
+        filled += len(updates)
+    return filled
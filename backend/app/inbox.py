@@ -0,0 +1,186 @@
+"""Поддержка таблицы chat_summaries — по строке на каждого участника чата.
+
+Прочитанность хранится отметкой last_read_letter_id: письмо прочитано адресатом,
+если его id не больше отметки адресата. Все функции только добавляют изменения
+в текущую транзакцию, commit делает вызывающий код.
+"""
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.orm import Session
+
+from . import DATABASE
+
+PREVIEW_LENGTH = 200
+
+summaries = DATABASE.ChatSummary.__table__
+
+
+def _preview(content: str) -> str:
+    return content[:PREVIEW_LENGTH]
+
+
+def create_summaries(db: Session, chat: DATABASE.Chat) -> None:
+    for user_id in (chat.user1_id, chat.user2_id):
+        db.add(DATABASE.ChatSummary(
+            chat_id=chat.id,
+            user_id=user_id,
+            updated_at=chat.created_at or datetime.utcnow()
+        ))
+
+
+def letter_created(db: Session, chat: DATABASE.Chat, letter: DATABASE.Letter) -> None:
+    result = db.execute(
+        summaries.update()
+        .where(summaries.c.chat_id == chat.id)
+        .values(
+            last_letter_id=letter.id,
+            last_letter_preview=_preview(letter.content),
+            last_letter_at=letter.created_at,
+            updated_at=letter.created_at,
+            # То же условие, что в letter_deleted: письмо за отметкой прочтения не считается непрочитанным
+            unread_count=summaries.c.unread_count + case(
+                (and_(summaries.c.user_id != letter.author_id,
+                      func.coalesce(summaries.c.last_read_letter_id, 0) < letter.id), 1),
+                else_=0
+            ),
+        )
+    )
+    if result.rowcount != 2:
+        # Чат появился до chat_summaries — собираем его строки с нуля
+        rebuild_chat(db, chat)
+
+
+def letter_updated(db: Session, letter: DATABASE.Letter) -> None:
+    db.execute(
+        summaries.update()
+        .where(summaries.c.chat_id == letter.chat_id, summaries.c.last_letter_id == letter.id)
+        .values(last_letter_preview=_preview(letter.content))
+    )
+
+
+def letter_deleted(db: Session, chat: DATABASE.Chat, letter: DATABASE.Letter) -> None:
+    db.execute(
+        summaries.update()
+        .where(
+            summaries.c.chat_id == chat.id,
+            summaries.c.user_id == _recipient_id(chat, letter.author_id),
+            func.coalesce(summaries.c.last_read_letter_id, 0) < letter.id,
+            summaries.c.unread_count > 0
+        )
+        .values(unread_count=summaries.c.unread_count - 1)
+    )
+
+    previous = _last_letter(db, chat.id, exclude_id=letter.id)
+    db.execute(
+        summaries.update()
+        .where(summaries.c.chat_id == chat.id, summaries.c.last_letter_id == letter.id)
+        .values(
+            last_letter_id=previous.id if previous else None,
+            last_letter_preview=_preview(previous.content) if previous else None,
+            last_letter_at=previous.created_at if previous else None,
+        )
+    )
+
+
+def mark_read(db: Session, chat_id: int, user_id: int, up_to_id: Optional[int] = None) -> bool:
+    """Сдвигает отметку прочтения вперёд одним UPDATE строки участника.
+
+    up_to_id=None — прочитано всё; отметка не уходит дальше последнего письма чата и не двигается назад.
+    Возвращает False, если отметка не изменилась.
+    """
+    last_letter_id = func.coalesce(summaries.c.last_letter_id, 0)
+    target = last_letter_id if up_to_id is None else case(
+        (last_letter_id < up_to_id, last_letter_id), else_=up_to_id
+    )
+    unread = (
+        select(func.count(DATABASE.Letter.id))
+        .where(
+            DATABASE.Letter.chat_id == chat_id,
+            DATABASE.Letter.author_id != user_id,
+            DATABASE.Letter.id > target
+        )
+        .scalar_subquery()
+    )
+    result = db.execute(
+        summaries.update()
+        .where(
+            summaries.c.chat_id == chat_id,
+            summaries.c.user_id == user_id,
+            func.coalesce(summaries.c.last_read_letter_id, 0) < target
+        )
+        .values(last_read_letter_id=target, unread_count=unread)
+    )
+    return result.rowcount > 0
+
+
+def read_marks(db: Session, chat_id: int) -> Dict[int, int]:
+    """{user_id: last_read_letter_id} для обоих участников чата."""
+    rows = db.query(DATABASE.ChatSummary.user_id, DATABASE.ChatSummary.last_read_letter_id).filter(
+        DATABASE.ChatSummary.chat_id == chat_id
+    ).all()
+    return {user_id: last_read or 0 for user_id, last_read in rows}
+
+
+def is_read(letter, marks: Dict[int, int]) -> bool:
+    # Отметка адресата — то есть участника, который не автор письма
+    return any(letter.id <= last_read for user_id, last_read in marks.items() if user_id != letter.author_id)
+
+
+def rebuild_chat(db: Session, chat: DATABASE.Chat) -> None:
+    last = _last_letter(db, chat.id)
+    for user_id in (chat.user1_id, chat.user2_id):
+        summary = db.query(DATABASE.ChatSummary).filter(
+            DATABASE.ChatSummary.chat_id == chat.id,
+            DATABASE.ChatSummary.user_id == user_id
+        ).first()
+        if summary is None:
+            summary = DATABASE.ChatSummary(chat_id=chat.id, user_id=user_id)
+            db.add(summary)
+
+        incoming = db.query(DATABASE.Letter.id).filter(
+            DATABASE.Letter.chat_id == chat.id,
+            DATABASE.Letter.author_id != user_id
+        )
+        if summary.last_read_letter_id is None:
+            # Старые данные: отметка — последнее входящее письмо, помеченное is_read
+            summary.last_read_letter_id = incoming.filter(
+                DATABASE.Letter.is_read == True
+            ).with_entities(func.max(DATABASE.Letter.id)).scalar()
+
+        summary.last_letter_id = last.id if last else None
+        summary.last_letter_preview = _preview(last.content) if last else None
+        summary.last_letter_at = last.created_at if last else None
+        summary.unread_count = incoming.filter(
+            DATABASE.Letter.id > (summary.last_read_letter_id or 0)
+        ).count()
+        summary.updated_at = chat.updated_at or chat.created_at
+    db.flush()
+
+
+def rebuild_all(db: Session, batch_size: int = 500) -> int:
+    rebuilt = 0
+    last_id = 0
+    while True:
+        chats = db.query(DATABASE.Chat).filter(
+            DATABASE.Chat.id > last_id
+        ).order_by(DATABASE.Chat.id).limit(batch_size).all()
+        if not chats:
+            return rebuilt
+        for chat in chats:
+            rebuild_chat(db, chat)
+        db.commit()
+        rebuilt += len(chats)
+        last_id = chats[-1].id
+
+
+def _recipient_id(chat: DATABASE.Chat, author_id: int) -> int:
+    return chat.user2_id if author_id == chat.user1_id else chat.user1_id
+
+
+def _last_letter(db: Session, chat_id: int, exclude_id: Optional[int] = None) -> Optional[DATABASE.Letter]:
+    query = db.query(DATABASE.Letter).filter(DATABASE.Letter.chat_id == chat_id)
+    if exclude_id is not None:
+        query = query.filter(DATABASE.Letter.id != exclude_id)
+    return query.order_by(DATABASE.Letter.created_at.desc(), DATABASE.Letter.id.desc()).first()
@@ -0,0 +1,193 @@
+"""Очередь фоновой обработки видео в таблице jobs.
+
+Веб-сервер только ставит задачи (enqueue_processing). Выполняет их отдельный процесс
+python -m app.manage worker: он забирает готовые задачи из БД и отдаёт тяжёлую работу
+в пул процессов, поэтому обработка не занимает потоки, обслуживающие запросы.
+"""
+import logging
+import os
+import random
+import signal
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from . import DATABASE, media, storage
+from .db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKER_PROCESSES = int(os.getenv("JOB_WORKER_PROCESSES", str(max(1, (os.cpu_count() or 2) // 2))))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Пауза перед повтором: base * 2^(попытка - 1), с разбросом ±20%
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+# Задача в статусе running дольше этого срока считается брошенной упавшим воркером
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "900"))
+
+PROCESS_VIDEO = "process_video"
+
+
+def enqueue_processing(db: Session, video: DATABASE.Video) -> DATABASE.Job:
+    """Ставит видео в очередь на обработку. Видео уже должно иметь id (после flush); commit делает вызывающий код."""
+    video.processing_status = "pending"
+    job = DATABASE.Job(kind=PROCESS_VIDEO, video_id=video.id, max_attempts=JOB_MAX_ATTEMPTS)
+    db.add(job)
+    return job
+
+
+def enqueue_many(db: Session, video_ids: List[int]) -> None:
+    """То же для пачки видео одним INSERT. processing_status вызывающий код ставит при вставке видео."""
+    if video_ids:
+        db.execute(DATABASE.Job.__table__.insert(), [
+            {"kind": PROCESS_VIDEO, "video_id": video_id, "max_attempts": JOB_MAX_ATTEMPTS}
+            for video_id in video_ids
+        ])
+
+
+def requeue_stale(db: Session) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    requeued = db.query(DATABASE.Job).filter(
+        DATABASE.Job.status == "running",
+        DATABASE.Job.locked_at < cutoff
+    ).update({"status": "queued", "locked_by": None, "locked_at": None}, synchronize_session=False)
+    db.commit()
+    return requeued
+
+
+def claim(db: Session, worker_id: str, limit: int) -> List[DATABASE.Job]:
+    """Забирает до limit готовых задач. Условный UPDATE по статусу не даёт двум воркерам взять одну задачу."""
+    if limit <= 0:
+        return []
+    now = datetime.utcnow()
+    candidates = [job_id for (job_id,) in db.query(DATABASE.Job.id).filter(
+        DATABASE.Job.status == "queued",
+        DATABASE.Job.run_after <= now
+    ).order_by(DATABASE.Job.run_after, DATABASE.Job.id).limit(limit * 2).all()]
+
+    claimed = []
+    for job_id in candidates:
+        if len(claimed) == limit:
+            break
+        result = db.query(DATABASE.Job).filter(
+            DATABASE.Job.id == job_id,
+            DATABASE.Job.status == "queued"
+        ).update({
+            "status": "running",
+            "locked_by": worker_id,
+            "locked_at": now,
+            "attempts": DATABASE.Job.attempts + 1
+        }, synchronize_session=False)
+        if result == 1:
+            claimed.append(job_id)
+    db.commit()
+
+    jobs = db.query(DATABASE.Job).filter(DATABASE.Job.id.in_(claimed)).all() if claimed else []
+    video_ids = [job.video_id for job in jobs]
+    if video_ids:
+        db.query(DATABASE.Video).filter(DATABASE.Video.id.in_(video_ids)).update(
+            {"processing_status": "processing"}, synchronize_session=False
+        )
+        db.commit()
+    return jobs
+
+
+def job_arguments(db: Session, job: DATABASE.Job):
+    """Аргументы для media.process_video или None, если видео уже удалено."""
+    video = db.query(DATABASE.Video).filter(DATABASE.Video.id == job.video_id).first()
+    if video is None:
+        return None
+    if video.file is not None:
+        poster = None if video.thumbnail_url else storage.poster_path(video.file.sha256)
+        return storage.file_path(video.file.sha256), None, video.file.sha256, poster
+    return None, video.video_url, None, None
+
+
+def finish(db: Session, job: DATABASE.Job, result: dict) -> None:
+    video = db.query(DATABASE.Video).filter(DATABASE.Video.id == job.video_id).first()
+    if video is not None:
+        # Длительность от клиента заменяем на прочитанную из файла
+        if result["duration"] is not None:
+            video.duration = result["duration"]
+        if result["poster"] and not video.thumbnail_url:
+            video.thumbnail_url = f"/api/video/{video.uuid}/poster"
+        video.processing_status = "ready"
+    job.status = "done"
+    job.last_error = None
+    job.locked_by = None
+    db.commit()
+
+
+def fail(db: Session, job: DATABASE.Job, error: BaseException) -> None:
+    permanent = isinstance(error, media.ProbeError)
+    job.last_error = f"{type(error).__name__}: {error}"[:2000]
+    job.locked_by = None
+    if permanent or job.attempts >= job.max_attempts:
+        job.status = "failed"
+        db.query(DATABASE.Video).filter(DATABASE.Video.id == job.video_id).update(
+            {"processing_status": "failed"}, synchronize_session=False
+        )
+    else:
+        delay = JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1) * random.uniform(0.8, 1.2)
+        job.status = "queued"
+        job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+        db.query(DATABASE.Video).filter(DATABASE.Video.id == job.video_id).update(
+            {"processing_status": "pending"}, synchronize_session=False
+        )
+    db.commit()
+
+
+class Worker:
+    def __init__(self, processes: int = JOB_WORKER_PROCESSES, poll_interval: float = JOB_POLL_INTERVAL_SECONDS):
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stopping = False
+
+    def stop(self, *_) -> None:
+        self._stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info("Worker %s started with %s processes", self.worker_id, self.processes)
+
+        running = {}
+        db = SessionLocal()
+        try:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                while not self._stopping or running:
+                    if not self._stopping:
+                        requeue_stale(db)
+                        for job in claim(db, self.worker_id, self.processes - len(running)):
+                            arguments = job_arguments(db, job)
+                            if arguments is None:
+                                job.status = "done"
+                                db.commit()
+                                continue
+                            running[pool.submit(media.process_video, *arguments)] = job.id
+
+                    if not running:
+                        # Пока задач нет, соединение с БД не держим
+                        db.close()
+                        time.sleep(self.poll_interval)
+                        continue
+
+                    done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = db.query(DATABASE.Job).filter(DATABASE.Job.id == running.pop(future)).first()
+                        if job is None:
+                            continue
+                        error = future.exception()
+                        if error is None:
+                            finish(db, job, future.result())
+                        else:
+                            logger.warning("Job %s failed (attempt %s): %r", job.id, job.attempts, error)
+                            fail(db, job, error)
+        finally:
+            db.close()
+        logger.info("Worker %s stopped", self.worker_id)
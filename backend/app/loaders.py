@@ -0,0 +1,59 @@
+"""Пакетная загрузка связей при сборке ответов.
+
+Вместо video.author.username в цикле (по запросу на строку) обработчик сначала отдаёт
+загрузчику все нужные id страницы (prime), а потом берёт строки через get: первый get
+выбирает всё накопленное одним IN-запросом. Загрузчики живут в db.info, то есть один
+на сессию — на HTTP-запрос.
+
+Загружаются только нужные колонки, а результат — Row, а не ORM-объекты: после commit
+сессия их не сбрасывает и не перечитывает по одному.
+"""
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from . import DATABASE
+
+
+class Loader:
+    def __init__(self, db: Session, key, *columns):
+        self.db = db
+        self.key = key
+        self.columns = (key,) + columns
+        self._rows: Dict[int, Optional[Row]] = {}
+        self._pending = set()
+
+    def prime(self, ids: Iterable[Optional[int]]) -> "Loader":
+        self._pending.update(id_ for id_ in ids if id_ is not None and id_ not in self._rows)
+        return self
+
+    def _load(self) -> None:
+        ids = list(self._pending)
+        self._pending.clear()
+        for row in self.db.query(*self.columns).filter(self.key.in_(ids)).all():
+            self._rows[row[0]] = row
+        for id_ in ids:
+            self._rows.setdefault(id_, None)
+
+    def get(self, id_: int) -> Optional[Row]:
+        if id_ not in self._rows:
+            self._pending.add(id_)
+            self._load()
+        return self._rows[id_]
+
+
+def _loader(db: Session, name: str, key, *columns) -> Loader:
+    loader = db.info.get(name)
+    if loader is None:
+        loader = db.info[name] = Loader(db, key, *columns)
+    return loader
+
+
+def user_loader(db: Session) -> Loader:
+    """(id, username) — всё, что нужно UserMinimal и author_name."""
+    return _loader(db, "user_loader", DATABASE.User.id, DATABASE.User.username)
+
+
+def video_loader(db: Session) -> Loader:
+    return _loader(db, "video_loader", DATABASE.Video.id, DATABASE.Video.title)
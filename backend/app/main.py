@@ -1,14 +1,59 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .db import engine
-from . import DATABASE
+from .db import engine, engines, dispose_async_engines, SessionLocal
+from . import DATABASE, search, realtime, querystats, routing, metrics, timing
 
-from fastapi.responses import JSONResponse
-from .routers import user, video, letter, comment
+from fastapi.responses import JSONResponse, PlainTextResponse
+from .routers import user, video, letter, comment, upload, stream
+from .viewcounter import view_counter
+from .cache import response_cache, RESPONSE_CACHE_WARMUP_PAGES
+from .background import PeriodicTask
+from .hashing import password_executor
+from .authLOGIK import purge_tokens_job, token_cache, TOKEN_PURGE_INTERVAL_SECONDS
+from .storage import collect_garbage_job, UPLOAD_GC_INTERVAL_SECONDS
 
 DATABASE.Base.metadata.create_all(bind=engine)
+search.setup(engine)
+for name, bound in engines().items():
+    querystats.install(bound)
+    metrics.pool_metrics.install(name, bound)
+
+
+token_purge = PeriodicTask("token-purge", TOKEN_PURGE_INTERVAL_SECONDS, purge_tokens_job)
+upload_gc = PeriodicTask("upload-gc", UPLOAD_GC_INTERVAL_SECONDS, collect_garbage_job)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    view_counter.start()
+    realtime.broker.start()
+    if TOKEN_PURGE_INTERVAL_SECONDS > 0:
+        token_purge.start()
+    if UPLOAD_GC_INTERVAL_SECONDS > 0:
+        upload_gc.start()
+    if RESPONSE_CACHE_WARMUP_PAGES:
+        db = SessionLocal()
+        try:
+            video.warm_catalog_cache(db, RESPONSE_CACHE_WARMUP_PAGES)
+        finally:
+            db.close()
+    yield
+    token_purge.stop()
+    upload_gc.stop()
+    realtime.broker.stop()
+    # Дописываем накопленные просмотры перед остановкой
+    view_counter.stop()
+    await dispose_async_engines()
+
 
-dwfu = FastAPI(title="DWFU")
+dwfu = FastAPI(title="DWFU", lifespan=lifespan)
+
+# Внутри QueryStatsMiddleware: берёт из неё время SQL
+dwfu.add_middleware(timing.ServerTimingMiddleware)
+dwfu.add_middleware(querystats.QueryStatsMiddleware)
+dwfu.add_middleware(routing.ReadRoutingMiddleware)
 
 # CORS
 dwfu.add_middleware(
@@ -17,18 +62,49 @@ dwfu.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Upload-Offset", "Content-Range", "Accept-Ranges",
+                    "X-Query-Count", "X-Query-Time-Ms", "Server-Timing"],
 )
+# Снаружи остальных: длительность включает и их работу
+dwfu.add_middleware(metrics.MetricsMiddleware)
 
 
 dwfu.include_router(user.users)
 dwfu.include_router(video.video)
+dwfu.include_router(stream.stream)
 dwfu.include_router(letter.chat)
 dwfu.include_router(letter.letter)
 dwfu.include_router(comment.comment)
+dwfu.include_router(upload.upload)
 
 @dwfu.get("/")
 def root():
     return {"message": "API is running"}
 
 
+@dwfu.get("/stats")
+def stats():
+    requests = metrics.request_metrics()
+    return {
+        "response_cache": response_cache.stats(),
+        "password_hashing": password_executor.stats(),
+        "realtime": realtime.hub.stats(),
+        "requests": requests.summary() if requests is not None else {},
+    }
+
+
+@dwfu.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    # async: пул потоков читается из event loop и сам не занимает поток
+    lines = []
+    requests = metrics.request_metrics()
+    if requests is not None:
+        requests.render(lines)
+    metrics.pool_metrics.render(lines)
+    metrics.render_threadpools(lines, {"password_hashing": password_executor})
+    metrics.render_caches(lines, {"response": response_cache, "token": token_cache})
+    lines.append("")
+    return PlainTextResponse("\n".join(lines), media_type=metrics.CONTENT_TYPE)
+
+
 
@@ -0,0 +1,91 @@
+"""Служебные команды: python -m app.manage <команда>"""
+import argparse
+import logging
+
+from sqlalchemy import func, select
+
+from . import DATABASE, search, inbox, storage, jobs
+from .importer import backfill_url_hashes
+from .authLOGIK import purge_tokens
+from .db import SessionLocal
+
+
+def recount_comments(db, batch_size: int = 1000) -> int:
+    """Пересчитывает videos.comments_count пачками по диапазону id, трогая только разошедшиеся строки."""
+    max_id = db.query(func.max(DATABASE.Video.id)).scalar() or 0
+    actual = (
+        select(func.count(DATABASE.Comment.id))
+        .where(DATABASE.Comment.video_id == DATABASE.Video.id)
+        .scalar_subquery()
+    )
+
+    fixed = 0
+    for start in range(1, max_id + 1, batch_size):
+        result = db.execute(
+            DATABASE.Video.__table__.update()
+            .where(DATABASE.Video.id.between(start, start + batch_size - 1))
+            .where(DATABASE.Video.comments_count != actual)
+            .values(comments_count=actual)
+        )
+        db.commit()
+        fixed += result.rowcount
+    return fixed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    recount = commands.add_parser("recount-comments", help="пересобрать счётчики комментариев у видео")
+    recount.add_argument("--batch-size", type=int, default=1000)
+
+    commands.add_parser("rebuild-search", help="перестроить поисковые индексы по видео и письмам")
+
+    purge = commands.add_parser("purge-tokens", help="удалить истёкшие и отозванные токены")
+    purge.add_argument("--batch-size", type=int, default=1000)
+
+    commands.add_parser("rebuild-inbox", help="пересобрать chat_summaries по всем чатам")
+
+    commands.add_parser("gc-uploads", help="удалить брошенные загрузки и файлы без ссылок")
+
+    backfill = commands.add_parser("backfill-url-hashes", help="проставить url_hash импортированным видео")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+
+    worker = commands.add_parser("worker", help="обрабатывать видео из очереди jobs")
+    worker.add_argument("--processes", type=int, default=jobs.JOB_WORKER_PROCESSES)
+    worker.add_argument("--poll-interval", type=float, default=jobs.JOB_POLL_INTERVAL_SECONDS)
+
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        # Воркер сам управляет сессиями и работает до SIGTERM/Ctrl+C
+        logging.basicConfig(level=logging.INFO)
+        jobs.Worker(args.processes, args.poll_interval).run()
+        return
+
+    db = SessionLocal()
+    try:
+        if args.command == "recount-comments":
+            fixed = recount_comments(db, args.batch_size)
+            print(f"Fixed comments_count on {fixed} videos")
+        elif args.command == "rebuild-search":
+            search.rebuild(db)
+            print("Search index rebuilt")
+        elif args.command == "purge-tokens":
+            deleted = purge_tokens(db, args.batch_size)
+            print(f"Deleted {deleted} tokens")
+        elif args.command == "rebuild-inbox":
+            rebuilt = inbox.rebuild_all(db)
+            print(f"Rebuilt inbox summaries for {rebuilt} chats")
+        elif args.command == "gc-uploads":
+            removed = storage.collect_garbage(db)
+            print(f"Removed {removed['sessions']} upload sessions and {removed['files']} files")
+        elif args.command == "backfill-url-hashes":
+            filled = backfill_url_hashes(db, args.batch_size)
+            print(f"Set url_hash on {filled} videos")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Разбор видеофайлов для фоновой обработки. Всё здесь выполняется в процессах воркера, без БД.
+
+Длительность берётся из заголовка MP4 (moov/mvhd) — читаются только заголовки боксов,
+поэтому для файла по ссылке хватает нескольких Range-запросов без скачивания целиком.
+"""
+import ipaddress
+import os
+import shutil
+import socket
+import struct
+import subprocess
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from .storage import hash_file
+
+MAX_TOP_LEVEL_BOXES = 64
+PROBE_TIMEOUT_SECONDS = float(os.getenv("MEDIA_PROBE_TIMEOUT_SECONDS", "10"))
+POSTER_WIDTH = 640
+
+Reader = Callable[[int, int], bytes]
+
+
+class ProbeError(Exception):
+    pass
+
+
+def _box_header(read: Reader, offset: int, end: int):
+    header = read(offset, 16)
+    if len(header) < 8:
+        return None
+    size, box_type = struct.unpack(">I4s", header[:8])
+    header_size = 8
+    if size == 1:
+        if len(header) < 16:
+            return None
+        size = struct.unpack(">Q", header[8:16])[0]
+        header_size = 16
+    elif size == 0:
+        size = end - offset
+    if size < header_size:
+        raise ProbeError(f"Broken MP4 box at offset {offset}")
+    return box_type, size, header_size
+
+
+def _mvhd_duration(payload: bytes) -> Optional[float]:
+    # Обрезанный mvhd — файл битый насовсем, повтор задачи не поможет
+    try:
+        version = payload[0]
+        if version == 1:
+            timescale, duration = struct.unpack(">IQ", payload[20:32])
+        else:
+            timescale, duration = struct.unpack(">II", payload[12:20])
+    except (IndexError, struct.error):
+        raise ProbeError("Truncated MP4 mvhd box")
+    if not timescale:
+        return None
+    return duration / timescale
+
+
+def mp4_duration(read: Reader, size: int) -> Optional[float]:
+    """Длительность в секундах из moov/mvhd или None, если это не MP4/MOV."""
+    offset = 0
+    for _ in range(MAX_TOP_LEVEL_BOXES):
+        if offset >= size:
+            return None
+        header = _box_header(read, offset, size)
+        if header is None:
+            return None
+        box_type, box_size, header_size = header
+        if box_type == b"moov":
+            child = offset + header_size
+            moov_end = offset + box_size
+            while child < moov_end:
+                child_header = _box_header(read, child, moov_end)
+                if child_header is None:
+                    return None
+                child_type, child_size, child_header_size = child_header
+                if child_type == b"mvhd":
+                    return _mvhd_duration(read(child + child_header_size, 32))
+                child += child_size
+            return None
+        offset += box_size
+    return None
+
+
+def file_reader(path: str):
+    f = open(path, "rb")
+
+    def read(offset: int, size: int) -> bytes:
+        f.seek(offset)
+        return f.read(size)
+
+    return f, read
+
+
+def _resolve_public_host(url: str) -> str:
+    """Адрес для подключения к хосту ссылки; все адреса хоста должны быть публичными."""
+    # Ссылку прислал пользователь: не даём воркеру ходить во внутреннюю сеть
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ProbeError("Only http(s) URLs can be probed")
+    infos = socket.getaddrinfo(parsed.hostname, parsed.port or 443, proto=socket.IPPROTO_TCP)
+    addresses = [ipaddress.ip_address(info[4][0]) for info in infos]
+    if not addresses or not all(address.is_global for address in addresses):
+        raise ProbeError("URL points to a non-public address")
+    return str(addresses[0])
+
+
+def remote_duration(url: str) -> Optional[float]:
+    # Подключаемся к проверенному адресу, а не к имени: иначе httpx резолвит его заново,
+    # и DNS может к этому моменту указать во внутреннюю сеть. Имя уходит в Host и в SNI,
+    # сертификат проверяется по нему же
+    target = httpx.URL(url)
+    pinned = target.copy_with(host=_resolve_public_host(url))
+    extensions = {"sni_hostname": target.host}
+
+    with httpx.Client(timeout=PROBE_TIMEOUT_SECONDS, follow_redirects=False,
+                      headers={"Host": target.netloc.decode("ascii")}) as client:
+        def get(first_byte: int, last_byte: int) -> httpx.Response:
+            return client.get(pinned, headers={"Range": f"bytes={first_byte}-{last_byte}"}, extensions=extensions)
+
+        def read(offset: int, size: int) -> bytes:
+            response = get(offset, offset + size - 1)
+            if response.status_code != 206:
+                raise ProbeError(f"Server does not support Range requests ({response.status_code})")
+            return response.content[:size]
+
+        first = get(0, 15)
+        content_range = first.headers.get("content-range", "")
+        if first.status_code != 206 or "/" not in content_range or content_range.endswith("/*"):
+            raise ProbeError("Cannot determine remote file size")
+        return mp4_duration(read, int(content_range.rsplit("/", 1)[1]))
+
+
+def make_poster(path: str, target: str, at_seconds: float) -> bool:
+    """Кадр-превью через ffmpeg, если он установлен. Без ffmpeg просто пропускаем."""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    result = subprocess.run(
+        [ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-ss", f"{at_seconds:.2f}", "-i", path,
+         "-frames:v", "1", "-vf", f"scale={POSTER_WIDTH}:-2", target],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60
+    )
+    if result.returncode != 0:
+        raise ProbeError(f"ffmpeg failed: {result.stderr.decode(errors='replace')[-500:]}")
+    return True
+
+
+def process_video(path: Optional[str], url: Optional[str], sha256: Optional[str],
+                  poster_path: Optional[str]) -> dict:
+    """Задача для процесса воркера: длительность, проверка хэша, кадр-превью. Возвращает найденное."""
+    result = {"duration": None, "sha256": None, "poster": False}
+
+    if path is not None:
+        f, read = file_reader(path)
+        with f:
+            duration = mp4_duration(read, os.fstat(f.fileno()).st_size)
+        result["sha256"] = hash_file(path)
+        if sha256 is not None and result["sha256"] != sha256:
+            raise ProbeError("Stored file is corrupted: content hash mismatch")
+        if poster_path is not None:
+            result["poster"] = make_poster(path, poster_path, min(1.0, (duration or 0) / 10))
+    elif url is not None:
+        duration = remote_duration(url)
+    else:
+        duration = None
+
+    if duration is not None:
+        result["duration"] = int(round(duration))
+    return result
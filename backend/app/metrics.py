@@ -0,0 +1,335 @@
+"""Метрики приложения в текстовом формате Prometheus (GET /metrics).
+
+MetricsMiddleware считает запросы по маршрутам (шаблон пути, как в querystats): число
+по кодам ответа и гистограмму длительности. p50/p95/p99 в Prometheus считает
+histogram_quantile по корзинам, оценка тех же квантилей с запуска — в /stats.
+
+На горячем пути нет блокировок: у каждого потока свой заранее выделенный массив
+счётчиков (Shards), при выдаче метрик массивы суммируются. Остальное — пулы соединений,
+пулы потоков, кэши — читается только в момент запроса /metrics.
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Tuple
+
+from anyio import to_thread
+from sqlalchemy import exc
+
+# Верхние границы корзин гистограммы длительности запроса, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Ожидание соединения из пула обычно на порядки короче запроса
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+# Коды, для которых заведены счётчики; остальные попадают в "other"
+STATUS_CODES = (200, 201, 204, 206, 304, 400, 401, 403, 404, 405, 409, 413, 416, 422, 429, 500, 503)
+
+UNMATCHED = ("", "<unmatched>")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Shards:
+    """Массив счётчиков на поток. Пишет только свой поток, поэтому без блокировок и без потерянных инкрементов.
+
+    Потоки пула anyio завершаются после простоя, а на их место приходят новые: массивы
+    завершившихся потоков при регистрации нового и при выдаче метрик складываются в общий
+    base, так что массивов не больше, чем живых потоков.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._base = [0] * size
+        self._arrays: List[Tuple[threading.Thread, list]] = []
+        self._lock = threading.Lock()
+
+    def array(self) -> list:
+        array = getattr(self._local, "array", None)
+        if array is None:
+            array = self._local.array = [0] * self.size
+            with self._lock:
+                self._fold_finished()
+                self._arrays.append((threading.current_thread(), array))
+        return array
+
+    def _fold_finished(self) -> None:
+        # Вызывается под self._lock. Завершившийся поток в свой массив уже не пишет
+        alive = []
+        for thread, array in self._arrays:
+            if thread.is_alive():
+                alive.append((thread, array))
+            else:
+                for i, value in enumerate(array):
+                    self._base[i] += value
+        self._arrays = alive
+
+    def totals(self) -> list:
+        with self._lock:
+            self._fold_finished()
+            totals = list(self._base)
+            for _, array in self._arrays:
+                for i, value in enumerate(array):
+                    totals[i] += value
+        return totals
+
+
+class Histogram:
+    """Несколько гистограмм с общими корзинами в одном Shards: по слоту на серию."""
+
+    def __init__(self, buckets: Tuple[float, ...], series: int):
+        self.buckets = buckets
+        # Корзины, +Inf, сумма
+        self.stride = len(buckets) + 2
+        self.shards = Shards(self.stride * series)
+
+    def observe(self, slot: int, value: float) -> None:
+        array = self.shards.array()
+        base = slot * self.stride
+        array[base + bisect_left(self.buckets, value)] += 1
+        array[base + self.stride - 1] += value
+
+    def series(self, slot: int, totals: list) -> Tuple[List[int], float]:
+        base = slot * self.stride
+        return totals[base:base + self.stride - 1], totals[base + self.stride - 1]
+
+
+def quantile(buckets: Tuple[float, ...], counts: List[int], q: float) -> float:
+    """Оценка квантиля по корзинам с линейной интерполяцией внутри корзины, как histogram_quantile."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if seen + count >= rank and count:
+            lower = buckets[i - 1] if i > 0 else 0.0
+            if i == len(buckets):
+                return lower
+            return lower + (buckets[i] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+
+class RequestMetrics:
+    """Счётчики запросов. Слоты маршрутов выделяются сразу по таблице маршрутов приложения."""
+
+    def __init__(self, routes: Iterable):
+        self.keys: List[Tuple[str, str]] = [UNMATCHED]
+        for route in routes:
+            for method in sorted(getattr(route, "methods", None) or ()):
+                self.keys.append((method, route.path))
+        self.slots: Dict[Tuple[str, str], int] = {key: slot for slot, key in enumerate(self.keys)}
+        self.status_slots = {code: i for i, code in enumerate(STATUS_CODES)}
+        self.status_stride = len(STATUS_CODES) + 1
+        self.statuses = Shards(self.status_stride * len(self.keys))
+        self.latency = Histogram(LATENCY_BUCKETS, len(self.keys))
+
+    def observe(self, method: str, path: str, status: int, seconds: float) -> None:
+        slot = self.slots.get((method, path), 0)
+        self.statuses.array()[slot * self.status_stride + self.status_slots.get(status, len(STATUS_CODES))] += 1
+        self.latency.observe(slot, seconds)
+
+    def render(self, lines: List[str]) -> None:
+        statuses = self.statuses.totals()
+        latency = self.latency.shards.totals()
+
+        lines.append("# HELP dwfu_http_requests_total HTTP requests by route and status code.")
+        lines.append("# TYPE dwfu_http_requests_total counter")
+        for slot, (method, path) in enumerate(self.keys):
+            base = slot * self.status_stride
+            for i, count in enumerate(statuses[base:base + self.status_stride]):
+                if count:
+                    code = str(STATUS_CODES[i]) if i < len(STATUS_CODES) else "other"
+                    lines.append(f"dwfu_http_requests_total{_labels(method=method, route=path, status=code)} {count}")
+
+        lines.append("# HELP dwfu_http_request_duration_seconds HTTP request latency by route.")
+        lines.append("# TYPE dwfu_http_request_duration_seconds histogram")
+        for slot, (method, path) in enumerate(self.keys):
+            counts, total = self.latency.series(slot, latency)
+            if sum(counts):
+                _render_histogram(lines, "dwfu_http_request_duration_seconds", LATENCY_BUCKETS, counts, total,
+                                  method=method, route=path)
+
+    def summary(self) -> dict:
+        latency = self.latency.shards.totals()
+        result = {}
+        for slot, (method, path) in enumerate(self.keys):
+            counts, total = self.latency.series(slot, latency)
+            requests = sum(counts)
+            if requests:
+                result[f"{method} {path}".strip()] = {
+                    "count": requests,
+                    "mean_ms": round(total / requests * 1000, 2),
+                    **{f"p{int(q * 100)}_ms": round(quantile(LATENCY_BUCKETS, counts, q) * 1000, 2)
+                       for q in (0.5, 0.95, 0.99)},
+                }
+        return result
+
+
+class PoolMetrics:
+    """Ожидание соединения из пула: время _do_get и число таймаутов, по движкам."""
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.engines = []
+        self.wait = Histogram(POOL_WAIT_BUCKETS, 16)
+        self.timeouts = Shards(16)
+
+    def install(self, name: str, engine) -> None:
+        slot = len(self.names)
+        if slot >= self.timeouts.size:
+            raise ValueError("Too many engines for pool metrics")
+        self.names.append(name)
+        self.engines.append(engine)
+
+        pool = engine.pool
+        # Подкласс, а не обёртка экземпляра: dispose() пересоздаёт пул через pool.__class__
+        base = type(pool)
+        pool.__class__ = type(base.__name__, (base,), {"_do_get": _timed_do_get(self, slot, base)})
+
+    def render(self, lines: List[str]) -> None:
+        gauges = (
+            ("dwfu_db_pool_size", "Configured pool size.", "size"),
+            ("dwfu_db_pool_checked_out", "Connections currently checked out.", "checkedout"),
+            ("dwfu_db_pool_overflow", "Connections opened beyond pool size (negative while the pool is filling).",
+             "overflow"),
+        )
+        for metric, help_text, method in gauges:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for name, engine in zip(self.names, self.engines):
+                # У SingletonThreadPool/StaticPool (SQLite в памяти) таких счётчиков нет
+                value = getattr(engine.pool, method, None)
+                if value is not None:
+                    lines.append(f"{metric}{_labels(engine=name)} {value()}")
+
+        wait = self.wait.shards.totals()
+        lines.append("# HELP dwfu_db_pool_wait_seconds Time to get a connection from the pool.")
+        lines.append("# TYPE dwfu_db_pool_wait_seconds histogram")
+        for slot, name in enumerate(self.names):
+            counts, total = self.wait.series(slot, wait)
+            _render_histogram(lines, "dwfu_db_pool_wait_seconds", POOL_WAIT_BUCKETS, counts, total, engine=name)
+
+        timeouts = self.timeouts.totals()
+        lines.append("# HELP dwfu_db_pool_timeouts_total Pool checkouts that timed out.")
+        lines.append("# TYPE dwfu_db_pool_timeouts_total counter")
+        for slot, name in enumerate(self.names):
+            lines.append(f"dwfu_db_pool_timeouts_total{_labels(engine=name)} {timeouts[slot]}")
+
+
+def _timed_do_get(metrics: PoolMetrics, slot: int, base):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return base._do_get(self)
+        except exc.TimeoutError:
+            metrics.timeouts.array()[slot] += 1
+            raise
+        finally:
+            metrics.wait.observe(slot, time.perf_counter() - started)
+    return _do_get
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _render_histogram(lines: List[str], metric: str, buckets: Tuple[float, ...], counts: List[int], total: float,
+                      **labels) -> None:
+    cumulative = 0
+    for bound, count in zip(buckets + (float("inf"),), counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{metric}_bucket{_labels(**labels, le=le)} {cumulative}")
+    lines.append(f"{metric}_sum{_labels(**labels)} {total}")
+    lines.append(f"{metric}_count{_labels(**labels)} {cumulative}")
+
+
+def render_threadpools(lines: List[str], executors: dict) -> None:
+    """Пул потоков anyio (sync-обработчики, run_in_threadpool) и свои пулы вроде хэширования паролей.
+
+    Вызывать из event loop: лимитер anyio привязан к нему.
+    """
+    limiter = to_thread.current_default_thread_limiter().statistics()
+    pools = {"anyio": (limiter.total_tokens, limiter.borrowed_tokens, limiter.tasks_waiting)}
+    for name, executor in executors.items():
+        stats = executor.stats()
+        pools[name] = (stats["workers"], min(stats["in_flight"], stats["workers"]),
+                       max(0, stats["in_flight"] - stats["workers"]))
+
+    for index, (metric, help_text) in enumerate((
+        ("dwfu_threadpool_threads", "Maximum worker threads."),
+        ("dwfu_threadpool_busy", "Threads running a task."),
+        ("dwfu_threadpool_waiting", "Tasks waiting for a free thread."),
+    )):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for name, values in pools.items():
+            lines.append(f"{metric}{_labels(pool=name)} {values[index]}")
+
+
+def render_caches(lines: List[str], caches: dict) -> None:
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    for key, metric, kind, help_text in (
+        ("hits", "dwfu_cache_hits_total", "counter", "Cache hits."),
+        ("misses", "dwfu_cache_misses_total", "counter", "Cache misses."),
+        ("size", "dwfu_cache_entries", "gauge", "Entries in cache."),
+        ("hit_ratio", "dwfu_cache_hit_ratio", "gauge", "Hits / (hits + misses) since start."),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, values in stats.items():
+            lines.append(f"{metric}{_labels(cache=name)} {values[key]}")
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.requests = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        if self.requests is None:
+            self.requests = requests_for(scope["app"])
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None)
+            self.requests.observe(scope["method"] if path else "", path or UNMATCHED[1], status,
+                                  time.perf_counter() - started)
+
+
+_requests = None
+_requests_lock = threading.Lock()
+
+
+def requests_for(app) -> RequestMetrics:
+    """Один RequestMetrics на процесс; маршруты берутся из приложения при первом запросе, когда они уже подключены."""
+    global _requests
+    with _requests_lock:
+        if _requests is None:
+            _requests = RequestMetrics(app.routes)
+    return _requests
+
+
+def request_metrics():
+    return _requests
+
+
+pool_metrics = PoolMetrics()
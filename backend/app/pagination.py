@@ -0,0 +1,39 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+# Курсор непрозрачен для клиента: base64 от [sort_by, order, значение ключа, id]
+
+
+def encode_cursor(sort_by: str, order: str, value: Any, row_id: int) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort_by, order, value, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_by: str, order: str) -> Tuple[Any, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, cursor_order, value, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        if sort_by == "created_at":
+            value = datetime.fromisoformat(value)
+        row_id = int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if cursor_sort != sort_by or cursor_order != order:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort_by/order")
+
+    return value, row_id
+
+
+def keyset_filter(column, id_column, order: str, value: Any, row_id: int):
+    # (column, id) сравниваются как кортеж, чтобы индекс (column, id) работал в обе стороны
+    if order == "desc":
+        return tuple_(column, id_column) < tuple_(value, row_id)
+    return tuple_(column, id_column) > tuple_(value, row_id)
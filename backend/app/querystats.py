@@ -0,0 +1,149 @@
+"""Счётчик SQL-запросов на HTTP-запрос и поиск N+1.
+
+Слушатели событий движка (install) складывают каждый запрос в QueryStats текущего
+HTTP-запроса — его кладёт в contextvar QueryStatsMiddleware. Если одна форма запроса
+повторилась QUERY_N_PLUS_ONE_THRESHOLD раз, в лог уходит предупреждение с маршрутом
+и текстом запроса: почти всегда это ленивая загрузка связи в цикле.
+
+Бюджет запросов в тестах:
+
+    with assert_max_queries(3):
+        client.get("/api/video/")
+"""
+import logging
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+QUERY_N_PLUS_ONE_THRESHOLD = int(os.getenv("QUERY_N_PLUS_ONE_THRESHOLD", "5"))
+# Больше запросов на один HTTP-запрос — повод посмотреть на обработчик, даже без явного N+1
+QUERY_COUNT_WARNING = int(os.getenv("QUERY_COUNT_WARNING", "30"))
+# X-Query-Count / X-Query-Time-Ms в ответе, для отладки; в продакшене выключено
+QUERY_STATS_HEADERS = os.getenv("QUERY_STATS_HEADERS", "0") == "1"
+
+_PLACEHOLDER = r"(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)"
+# IN (?, ?, ?) разной длины — это одна и та же форма запроса
+_PLACEHOLDER_LIST = re.compile(rf"\(\s*{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    return _PLACEHOLDER_LIST.sub("(?)", _SPACES.sub(" ", statement).strip())
+
+
+class QueryStats:
+    def __init__(self, keep_statements: bool = False):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.statements = [] if keep_statements else None
+
+    def record(self, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.duration += seconds
+        self.shapes[statement_shape(statement)] += 1
+        if self.statements is not None:
+            self.statements.append(statement)
+
+    def repeated(self, threshold: int = QUERY_N_PLUS_ONE_THRESHOLD) -> List[Tuple[str, int]]:
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+# Бюджеты assert_max_queries — тоже в контексте: TestClient и run_in_threadpool копируют его в поток
+# приложения, а фоновые потоки (сброс просмотров, очередь jobs) его не получают и в бюджет не попадают
+_watchers: ContextVar[Tuple[QueryStats, ...]] = ContextVar("query_budgets", default=())
+
+
+def current() -> Optional[QueryStats]:
+    return _current.get()
+
+
+def _record(statement: str, seconds: float) -> None:
+    stats = _current.get()
+    if stats is not None:
+        stats.record(statement, seconds)
+    for watcher in _watchers.get():
+        watcher.record(statement, seconds)
+
+
+def install(engine) -> None:
+    """Подключает подсчёт к движку. Вызывается для каждого движка приложения."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_started", None)
+        _record(statement, time.perf_counter() - started if started is not None else 0.0)
+
+
+@contextmanager
+def collect():
+    """Собирает запросы текущего контекста (и потоков, куда он скопирован) в новый QueryStats."""
+    stats = QueryStats()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def assert_max_queries(limit: int):
+    """AssertionError, если внутри блока выполнено больше limit запросов. Работает и как декоратор теста."""
+    stats = QueryStats(keep_statements=True)
+    token = _watchers.set(_watchers.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _watchers.reset(token)
+    if stats.count > limit:
+        listing = "\n".join(f"  {statement}" for statement in stats.statements)
+        raise AssertionError(f"Expected at most {limit} queries, got {stats.count}:\n{listing}")
+
+
+def route_path(scope) -> str:
+    # Шаблон маршрута (/api/video/{video_id}), а не конкретный путь: так запросы группируются по обработчику
+    route = scope.get("route")
+    return getattr(route, "path", None) or scope.get("path", "")
+
+
+def report(method: str, path: str, stats: QueryStats) -> None:
+    for shape, count in stats.repeated():
+        logger.warning("Probable N+1 in %s %s: %s x %s", method, path, count, shape[:500])
+    if stats.count >= QUERY_COUNT_WARNING:
+        logger.warning("%s %s ran %s queries (%.1f ms in SQL)", method, path, stats.count, stats.duration * 1000)
+
+
+class QueryStatsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-Query-Count"] = str(stats.count)
+                headers["X-Query-Time-Ms"] = f"{stats.duration * 1000:.1f}"
+            await send(message)
+
+        with collect() as stats:
+            try:
+                await self.app(scope, receive, send_with_headers if QUERY_STATS_HEADERS else send)
+            finally:
+                report(scope["method"], route_path(scope), stats)
@@ -0,0 +1,172 @@
+"""Доставка событий по письмам через WebSocket.
+
+Обработчики публикуют событие через брокер, брокер отдаёт его хабу каждого воркера,
+а хаб раскладывает его по очередям подключений адресатов.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# "memory" — только внутри процесса; иначе путь к своему классу: "package.module:ClassName"
+REALTIME_BROKER = os.getenv("REALTIME_BROKER", "memory")
+# Сколько событий может ждать отправки одному клиенту, дальше клиент отключается
+REALTIME_QUEUE_SIZE = int(os.getenv("REALTIME_QUEUE_SIZE", "256"))
+
+# 1013 Try Again Later — клиент не успевал читать события
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+Deliver = Callable[[List[int], dict], None]
+
+
+class Broker(ABC):
+    """Транспорт событий между воркерами.
+
+    publish() вызывается из обработчиков после commit; каждое событие, полученное брокером
+    (в том числе от других воркеров), он передаёт в deliver(user_ids, event).
+    """
+
+    def __init__(self, deliver: Deliver):
+        self.deliver = deliver
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    def publish(self, user_ids: List[int], event: dict) -> None:
+        ...
+
+
+class InMemoryBroker(Broker):
+    """Брокер на один процесс: событие сразу уходит в локальный хаб."""
+
+    def publish(self, user_ids: List[int], event: dict) -> None:
+        self.deliver(user_ids, event)
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, user_id: int, queue_size: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.evicted = False
+        self.sender = None
+
+    async def send_loop(self) -> None:
+        while True:
+            event = await self.queue.get()
+            await self.websocket.send_json(event)
+
+    async def receive_loop(self) -> None:
+        # Входящие сообщения не нужны, кроме ping; чтение нужно, чтобы заметить отключение
+        while True:
+            message = await self.websocket.receive_text()
+            if message == "ping":
+                self.offer({"type": "pong"})
+
+    def offer(self, event: dict) -> bool:
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.evicted = True
+            self.sender.cancel()
+            return False
+
+
+class Hub:
+    """Подключения по пользователям. deliver() можно вызывать из любого потока."""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.delivered = 0
+        self.evicted = 0
+        self._connections: Dict[int, Set[Connection]] = {}
+        self._lock = threading.Lock()
+
+    def deliver(self, user_ids: Iterable[int], event: dict) -> None:
+        with self._lock:
+            targets = [conn for user_id in set(user_ids) for conn in self._connections.get(user_id, ())]
+        for conn in targets:
+            try:
+                conn.loop.call_soon_threadsafe(self._offer, conn, event)
+            except RuntimeError:
+                # Цикл событий уже закрыт — подключение вот-вот исчезнет
+                pass
+
+    def _offer(self, conn: Connection, event: dict) -> None:
+        if conn.evicted:
+            return
+        if conn.offer(event):
+            self.delivered += 1
+        else:
+            self.evicted += 1
+            logger.warning("Disconnecting slow websocket consumer (user %s)", conn.user_id)
+
+    async def serve(self, websocket: WebSocket, user_id: int) -> None:
+        conn = Connection(websocket, user_id, self.queue_size)
+        conn.sender = asyncio.create_task(conn.send_loop())
+        receiver = asyncio.create_task(conn.receive_loop())
+        with self._lock:
+            self._connections.setdefault(user_id, set()).add(conn)
+
+        try:
+            done, pending = await asyncio.wait({conn.sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if not task.cancelled() and not isinstance(task.exception(), (WebSocketDisconnect, type(None))):
+                    logger.warning("Websocket of user %s failed: %r", user_id, task.exception())
+        finally:
+            with self._lock:
+                connections = self._connections.get(user_id)
+                if connections is not None:
+                    connections.discard(conn)
+                    if not connections:
+                        del self._connections[user_id]
+
+        if conn.evicted:
+            try:
+                await websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._connections),
+                "connections": sum(len(connections) for connections in self._connections.values()),
+                "delivered": self.delivered,
+                "evicted": self.evicted,
+            }
+
+
+def create_broker(spec: str, deliver: Deliver) -> Broker:
+    if spec == "memory":
+        return InMemoryBroker(deliver)
+    module_name, _, class_name = spec.partition(":")
+    broker_class = getattr(importlib.import_module(module_name), class_name)
+    return broker_class(deliver)
+
+
+hub = Hub(REALTIME_QUEUE_SIZE)
+broker = create_broker(REALTIME_BROKER, hub.deliver)
+
+
+def publish(user_ids: List[int], event: dict) -> None:
+    # Вызывается уже после commit: сбой доставки не должен превращать успешный запрос в ошибку
+    try:
+        broker.publish(user_ids, event)
+    except Exception:
+        logger.exception("Failed to publish %s event", event.get("type"))
@@ -1,28 +1,25 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import List
 import uuid
 from datetime import datetime
 
 from .. import DATABASE, Pshemas
-from ..db import get_db
-from ..authLOGIK import get_current_user
+from ..db import get_db, get_async_db
+from ..timing import TimedRoute
+from ..authLOGIK import get_current_user, CurrentUser
+from ..cache import response_cache, CATALOG_TAG, video_tag
+from ..loaders import user_loader
 
 def create_id() -> str:
     return str(uuid.uuid4())
 
 
-comment = APIRouter(prefix="/api/video/{video_id}/comments", tags=["comment"])
+comment = APIRouter(prefix="/api/video/{video_id}/comments", tags=["comment"], route_class=TimedRoute)
 
 
-@comment.get("/", response_model=List[Pshemas.CommentResponse])
-def get_video_lessen_comments(
-        video_id: int,
-        skip: int = Query(0, ge=0),
-        limit: int = Query(50, ge=1, le=100),
-        db: Session = Depends(get_db)
-):
-
+def comment_page(db: Session, video_id: int, skip: int, limit: int) -> List[dict]:
     video = db.query(DATABASE.Video).filter(DATABASE.Video.id == video_id).first()
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
@@ -33,6 +30,8 @@ def get_video_lessen_comments(
         DATABASE.Comment.created_at.desc()
     ).offset(skip).limit(limit).all()
 
+    authors = user_loader(db).prime(comment.author_id for comment in comments)
+
     result = []
     for comment in comments:
         result.append({
@@ -41,7 +40,7 @@ def get_video_lessen_comments(
             "content": comment.content,
             "video_id": comment.video_id,
             "author_id": comment.author_id,
-            "author_name": comment.author.username,
+            "author_name": authors.get(comment.author_id).username,
             "created_at": comment.created_at,
             "updated_at": comment.updated_at
         })
@@ -49,12 +48,22 @@ def get_video_lessen_comments(
     return result
 
 
+@comment.get("/", response_model=List[Pshemas.CommentResponse])
+async def get_video_lessen_comments(
+        video_id: int,
+        skip: int = Query(0, ge=0),
+        limit: int = Query(50, ge=1, le=100),
+        db: AsyncSession = Depends(get_async_db)
+):
+    return await db.run_sync(comment_page, video_id, skip, limit)
+
+
 @comment.post("/create_comment", response_model=Pshemas.CommentResponse, status_code=status.HTTP_201_CREATED)
 def create_comment(
     video_id: int,
     comment_data: Pshemas.CommentCreate,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
 
     video = db.query(DATABASE.Video).filter(DATABASE.Video.id == video_id).first()
@@ -71,6 +80,7 @@ def create_comment(
     db.add(new_comment)
     db.commit()
     db.refresh(new_comment)
+    response_cache.invalidate(CATALOG_TAG, video_tag(video_id))
 
     return {
         "id": new_comment.id,
@@ -89,7 +99,7 @@ def update_comment(
     comment_id: int,
     comment_data: Pshemas.CommentUpdate,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     comment = db.query(DATABASE.Comment).filter(DATABASE.Comment.id == comment_id).first()
 
@@ -124,7 +134,7 @@ def update_comment(
 def delete_comment(
     comment_id: int,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     comment = db.query(DATABASE.Comment).filter(DATABASE.Comment.id == comment_id).first()
 
@@ -137,7 +147,9 @@ def delete_comment(
             detail="You can only delete your own comments"
         )
 
+    video_id = comment.video_id
     db.delete(comment)
     db.commit()
+    response_cache.invalidate(CATALOG_TAG, video_tag(video_id))
 
     return None
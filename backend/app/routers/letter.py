@@ -1,12 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response, WebSocket
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import or_, and_, func
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 
-from ..db import get_db
-from .. import DATABASE, Pshemas
-from ..authLOGIK import get_current_user
+from ..db import get_db, get_async_db, SessionLocal
+from ..timing import TimedRoute
+from .. import DATABASE, Pshemas, inbox, realtime
+from ..pagination import keyset_filter
+from ..search import search_letters
+from ..authLOGIK import get_current_user, verify_access_token, CurrentUser
+from ..loaders import user_loader
+from ..routing import use_primary
 
 def get_chat_between_users(db: Session, user1_id: int, user2_id: int):
     return db.query(DATABASE.Chat).filter(
@@ -17,55 +24,242 @@ def get_chat_between_users(db: Session, user1_id: int, user2_id: int):
     ).first()
 
 
-chat = APIRouter(prefix="/api/chats", tags=["chats"])
+def letter_page_query(db: Session, chat_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None):
+    """Страница писем по ключу (created_at, id) — индекс idx_letter_chat_created вместо OFFSET.
+
+    before_id: письма старше указанного, от новых к старым; after_id: новее указанного, от старых к новым.
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+
+    order = "asc" if after_id is not None else "desc"
+    query = db.query(DATABASE.Letter).filter(DATABASE.Letter.chat_id == chat_id)
+
+    anchor_id = after_id if after_id is not None else before_id
+    if anchor_id is not None:
+        anchor = db.query(DATABASE.Letter.created_at).filter(
+            DATABASE.Letter.id == anchor_id,
+            DATABASE.Letter.chat_id == chat_id
+        ).first()
+        if anchor is not None:
+            query = query.filter(keyset_filter(
+                DATABASE.Letter.created_at, DATABASE.Letter.id, order, anchor.created_at, anchor_id
+            ))
+        else:
+            # Опорное письмо уже удалено: id растут вместе с created_at, сравниваем по id
+            query = query.filter(DATABASE.Letter.id > anchor_id if order == "asc" else DATABASE.Letter.id < anchor_id)
+
+    if order == "asc":
+        return query.order_by(DATABASE.Letter.created_at.asc(), DATABASE.Letter.id.asc())
+    return query.order_by(DATABASE.Letter.created_at.desc(), DATABASE.Letter.id.desc())
+
+
+def letter_response(letter: DATABASE.Letter, marks: Dict[int, int], author=None) -> dict:
+    # is_read не хранится в письме, а выводится из отметки прочтения адресата
+    return {
+        "id": letter.id,
+        "chat_id": letter.chat_id,
+        "author_id": letter.author_id,
+        "author": author or letter.author,
+        "content": letter.content,
+        "is_read": inbox.is_read(letter, marks),
+        "created_at": letter.created_at
+    }
+
+
+def publish_letter_event(chat: DATABASE.Chat, event_type: str, letter: DATABASE.Letter,
+                         marks: Dict[int, int]) -> None:
+    realtime.publish([chat.user1_id, chat.user2_id], {
+        "type": event_type,
+        "chat_id": chat.id,
+        "letter": Pshemas.LetterResponse.model_validate(letter_response(letter, marks)).model_dump(mode="json")
+    })
+
+
+def publish_read_event(db: Session, chat: DATABASE.Chat, reader_id: int) -> None:
+    # Собеседник узнаёт, что его письма прочитаны (✓✓), без перезапроса истории
+    realtime.publish([chat.user1_id, chat.user2_id], {
+        "type": "chat.read",
+        "chat_id": chat.id,
+        "user_id": reader_id,
+        "last_read_letter_id": inbox.read_marks(db, chat.id).get(reader_id)
+    })
+
+
+def count_unread(db: Session, user_id: int) -> int:
+    # Сумма готовых счётчиков по индексу (user_id, updated_at) вместо подсчёта писем
+    return db.query(func.coalesce(func.sum(DATABASE.ChatSummary.unread_count), 0)).filter(
+        DATABASE.ChatSummary.user_id == user_id
+    ).scalar()
+
+
+def _authenticate_websocket(token: str) -> CurrentUser:
+    db = SessionLocal()
+    try:
+        return verify_access_token(db, token)
+    finally:
+        db.close()
+
+
+chat = APIRouter(prefix="/api/chats", tags=["chats"], route_class=TimedRoute)
+
+
+@chat.websocket("/ws")
+async def chat_updates(websocket: WebSocket, token: Optional[str] = Query(None)):
+    """События по всем чатам пользователя: letter.created, letter.updated, letter.deleted, chat.read.
+
+    Браузер не умеет ставить заголовки на WebSocket, поэтому токен можно передать в ?token=.
+    """
+    if token is None:
+        authorization = websocket.headers.get("authorization", "")
+        scheme, _, credentials = authorization.partition(" ")
+        token = credentials if scheme.lower() == "bearer" else None
+
+    try:
+        if token is None:
+            raise HTTPException(status_code=401)
+        current_user = await run_in_threadpool(_authenticate_websocket, token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    await realtime.hub.serve(websocket, current_user.id)
+
 
 @chat.get("/my", response_model=List[Pshemas.ChatResponse])
 def get_my_chats(
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user),
+    current_user: CurrentUser = Depends(get_current_user),
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=100)
 ):
-
-    chats = db.query(DATABASE.Chat).filter(
-        or_(
-            DATABASE.Chat.user1_id == current_user.id,
-            DATABASE.Chat.user2_id == current_user.id
+    # Один запрос по индексу (user_id, updated_at): сводка + чат + оба участника + последнее письмо
+    user1 = aliased(DATABASE.User)
+    user2 = aliased(DATABASE.User)
+    other_summary = aliased(DATABASE.ChatSummary)
+
+    rows = db.query(
+        DATABASE.ChatSummary, DATABASE.Chat, user1, user2, DATABASE.Letter, other_summary.last_read_letter_id
+    ).join(
+        DATABASE.Chat, DATABASE.Chat.id == DATABASE.ChatSummary.chat_id
+    ).join(
+        user1, user1.id == DATABASE.Chat.user1_id
+    ).join(
+        user2, user2.id == DATABASE.Chat.user2_id
+    ).outerjoin(
+        DATABASE.Letter, DATABASE.Letter.id == DATABASE.ChatSummary.last_letter_id
+    ).outerjoin(
+        other_summary, and_(
+            other_summary.chat_id == DATABASE.ChatSummary.chat_id,
+            other_summary.user_id != current_user.id
         )
+    ).filter(
+        DATABASE.ChatSummary.user_id == current_user.id
     ).order_by(
-        DATABASE.Chat.updated_at.desc()
+        DATABASE.ChatSummary.updated_at.desc(),
+        DATABASE.ChatSummary.id.desc()
     ).offset(skip).limit(limit).all()
 
     result = []
-    for chat in chats:
-        other_user = chat.user2 if chat.user1_id == current_user.id else chat.user1
-
-        unread_count = db.query(DATABASE.Letter).filter(
-            DATABASE.Letter.chat_id == chat.id,
-            DATABASE.Letter.author_id != current_user.id,
-            DATABASE.Letter.is_read == False
-        ).count()
-
-        last_letter = chat.letters[-1] if chat.letters else None
+    for summary, chat, chat_user1, chat_user2, last_letter, other_last_read in rows:
+        last_letter_dict = None
+        if last_letter is not None:
+            other_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
+            marks = {current_user.id: summary.last_read_letter_id or 0, other_id: other_last_read or 0}
+            author = chat_user1 if last_letter.author_id == chat_user1.id else chat_user2
+            last_letter_dict = letter_response(last_letter, marks, author)
 
         result.append({
             "id": chat.id,
-            "user1": chat.user1,
-            "user2": chat.user2,
+            "user1": chat_user1,
+            "user2": chat_user2,
             "created_at": chat.created_at,
             "updated_at": chat.updated_at,
-            "last_letter": last_letter,
-            "unread_count": unread_count
+            "last_letter": last_letter_dict,
+            "last_letter_preview": summary.last_letter_preview,
+            "unread_count": summary.unread_count
         })
 
     return result
 
 
-@chat.get("/with/{other_user_id}", response_model=Pshemas.ChatDetailResponse)
+@chat.get("/unread/count", response_model=int)
+def get_total_unread_count(
+        db: Session = Depends(get_db),
+        current_user: CurrentUser = Depends(get_current_user)
+):
+    return count_unread(db, current_user.id)
+
+
+@chat.get("/search", response_model=List[Pshemas.LetterSearchResult])
+def search_my_letters(
+        response: Response,
+        q: str = Query(..., min_length=1, max_length=200),
+        chat_id: Optional[int] = Query(None, description="Искать только в одном чате"),
+        limit: int = Query(20, ge=1, le=100),
+        cursor: Optional[str] = Query(None, description="X-Next-Cursor из предыдущего ответа"),
+        db: Session = Depends(get_db),
+        current_user: CurrentUser = Depends(get_current_user)
+):
+    rows, next_cursor = search_letters(db, current_user.id, q, limit, cursor, chat_id)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return [
+        {
+            "id": letter.id,
+            "chat_id": letter.chat_id,
+            "author_id": letter.author_id,
+            "author": author,
+            "snippet": snippet,
+            "created_at": letter.created_at
+        }
+        for letter, author, snippet in rows
+    ]
+
+
+@chat.post("/{chat_id}/read", response_model=Pshemas.ChatReadResponse)
+def mark_chat_read(
+        chat_id: int,
+        up_to_id: Optional[int] = Query(None, description="Прочитано всё до этого письма включительно; по умолчанию — весь чат"),
+        db: Session = Depends(get_db),
+        current_user: CurrentUser = Depends(get_current_user)
+):
+    chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+
+    if chat.user1_id != current_user.id and chat.user2_id != current_user.id:
+        raise HTTPException(
+            status_code=403,
+            detail="You are not a participant of this chat"
+        )
+
+    moved = inbox.mark_read(db, chat_id, current_user.id, up_to_id)
+    db.commit()
+    if moved:
+        publish_read_event(db, chat, current_user.id)
+
+    summary = db.query(DATABASE.ChatSummary).filter(
+        DATABASE.ChatSummary.chat_id == chat_id,
+        DATABASE.ChatSummary.user_id == current_user.id
+    ).first()
+
+    return {
+        "chat_id": chat_id,
+        "last_read_letter_id": summary.last_read_letter_id if summary else None,
+        "unread_count": summary.unread_count if summary else 0
+    }
+
+
+# Чат создаётся по результату чтения: с отстающей реплики вышел бы дубль
+@chat.get("/with/{other_user_id}", response_model=Pshemas.ChatDetailResponse, dependencies=[Depends(use_primary)])
 def get_or_create_chat(
     other_user_id: int,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user),
+    limit: int = Query(50, ge=1, le=100)
 ):
 
     if current_user.id == other_user_id:
@@ -86,20 +280,26 @@ def get_or_create_chat(
             user2_id=other_user_id
         )
         db.add(chat)
+        db.flush()
+        inbox.create_summaries(db, chat)
         db.commit()
         db.refresh(chat)
 
-    letters = db.query(DATABASE.Letter).filter(
-        DATABASE.Letter.chat_id == chat.id
-    ).order_by(DATABASE.Letter.created_at.asc()).all()
+    # Только последняя страница; более старые — через GET /letters/?before_id=next_before_id
+    letters = letter_page_query(db, chat.id).limit(limit).all()
+    marks = inbox.read_marks(db, chat.id)
+    next_before_id = letters[-1].id if len(letters) == limit else None
+    # Авторы писем — всегда кто-то из двух участников: оба одним запросом
+    users = user_loader(db).prime([chat.user1_id, chat.user2_id])
 
     return {
         "id": chat.id,
-        "user1": chat.user1,
-        "user2": chat.user2,
+        "user1": users.get(chat.user1_id),
+        "user2": users.get(chat.user2_id),
         "created_at": chat.created_at,
         "updated_at": chat.updated_at,
-        "letters": letters,
+        "letters": [letter_response(letter, marks, users.get(letter.author_id)) for letter in reversed(letters)],
+        "next_before_id": next_before_id,
         "unread_count": 0
     }
 
@@ -109,7 +309,7 @@ def get_or_create_chat(
 def delete_chat(
     chat_id: int,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
 
@@ -129,40 +329,63 @@ def delete_chat(
 
 
 
-letter = APIRouter(prefix="/api/chats/{chat_id}/letters", tags=["letter"])
-
-@letter.get("/", response_model=List[Pshemas.LetterResponse])
-def get_letters(
-    chat_id: int,
-    db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user),
-    skip: int = Query(0, ge=0),
-    limit: int = Query(50, ge=1, le=100)
-):
+letter = APIRouter(prefix="/api/chats/{chat_id}/letters", tags=["letter"], route_class=TimedRoute)
 
+def letter_page(db: Session, chat_id: int, user_id: int, skip: int, limit: int,
+                before_id: Optional[int], after_id: Optional[int]) -> Tuple[List[dict], Optional[str]]:
     chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    if chat.user1_id != current_user.id and chat.user2_id != current_user.id:
+    if chat.user1_id != user_id and chat.user2_id != user_id:
         raise HTTPException(
             status_code=403,
             detail="You are not a participant of this chat"
         )
 
-    letters = db.query(DATABASE.Letter).filter(
-        DATABASE.Letter.chat_id == chat_id
-    ).order_by(
-        DATABASE.Letter.created_at.desc()
-    ).offset(skip).limit(limit).all()
+    query = letter_page_query(db, chat_id, before_id, after_id)
+    if before_id is None and after_id is None:
+        # skip оставлен для старых клиентов
+        query = query.offset(skip)
+    letters = query.limit(limit).all()
 
-    for letter in letters:
-        if letter.author_id != current_user.id and not letter.is_read:
-            letter.is_read = True
+    # X-Next-Cursor: before_id следующей (более старой) страницы или after_id для следующей синхронизации
+    next_cursor = None
+    if after_id is not None:
+        next_cursor = str(letters[-1].id if letters else after_id)
+    elif len(letters) == limit:
+        next_cursor = str(letters[-1].id)
 
-    db.commit()
+    # Отметка прочтения сдвигается до самого нового из полученных писем — одна строка вместо письма за письмом
+    moved = bool(letters) and inbox.mark_read(db, chat_id, user_id, max(letter.id for letter in letters))
+
+    # Ответ собираем до commit: после него сессия сбросила бы письма и перечитывала их по одному
+    marks = inbox.read_marks(db, chat_id)
+    authors = user_loader(db).prime([chat.user1_id, chat.user2_id])
+    result = [letter_response(letter, marks, authors.get(letter.author_id)) for letter in letters]
+
+    if moved:
+        db.commit()
+        publish_read_event(db, chat, user_id)
+
+    return result, next_cursor
 
-    return letters
+
+@letter.get("/", response_model=List[Pshemas.LetterResponse])
+async def get_letters(
+    chat_id: int,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentUser = Depends(get_current_user),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=100),
+    before_id: Optional[int] = Query(None, description="Письма старше этого, от новых к старым"),
+    after_id: Optional[int] = Query(None, description="Письма новее этого, от старых к новым — для досинхронизации")
+):
+    result, next_cursor = await db.run_sync(letter_page, chat_id, current_user.id, skip, limit, before_id, after_id)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return result
 
 
 @letter.post("/", response_model=Pshemas.LetterResponse, status_code=status.HTTP_201_CREATED)
@@ -170,7 +393,7 @@ def create_letter(
         chat_id: int,
         letter_data: Pshemas.LetterCreate,
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
     chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
     if not chat:
@@ -191,10 +414,14 @@ def create_letter(
     chat.updated_at = datetime.utcnow()
 
     db.add(new_letter)
+    db.flush()
+    inbox.letter_created(db, chat, new_letter)
     db.commit()
     db.refresh(new_letter)
+    # Новое письмо заведомо не прочитано адресатом
+    publish_letter_event(chat, "letter.created", new_letter, {})
 
-    return new_letter
+    return letter_response(new_letter, {})
 
 
 @letter.get("/{letter_id}", response_model=Pshemas.LetterResponse)
@@ -202,7 +429,7 @@ def get_letter(
         chat_id: int,
         letter_id: int,
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
     chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
     if not chat:
@@ -224,11 +451,11 @@ def get_letter(
     if not letter:
         raise HTTPException(status_code=404, detail="Letter not found")
 
-    if letter.author_id != current_user.id and not letter.is_read:
-        letter.is_read = True
+    if letter.author_id != current_user.id and inbox.mark_read(db, chat_id, current_user.id, letter.id):
         db.commit()
+        publish_read_event(db, chat, current_user.id)
 
-    return letter
+    return letter_response(letter, inbox.read_marks(db, chat_id))
 
 
 @letter.put("/{letter_id}", response_model=Pshemas.LetterResponse)
@@ -237,7 +464,7 @@ def update_letter(
         letter_id: int,
         letter_data: Pshemas.LetterCreate,
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
 
     chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
@@ -261,10 +488,13 @@ def update_letter(
         )
 
     letter.content = letter_data.content
+    inbox.letter_updated(db, letter)
     db.commit()
     db.refresh(letter)
+    marks = inbox.read_marks(db, chat_id)
+    publish_letter_event(chat, "letter.updated", letter, marks)
 
-    return letter
+    return letter_response(letter, marks)
 
 
 @letter.delete("/{letter_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -272,7 +502,7 @@ def delete_letter(
         chat_id: int,
         letter_id: int,
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
 
     chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
@@ -295,9 +525,16 @@ def delete_letter(
             detail="You can only delete your own messages"
         )
 
+    inbox.letter_deleted(db, chat, letter)
     db.delete(letter)
     db.commit()
 
+    realtime.publish([chat.user1_id, chat.user2_id], {
+        "type": "letter.deleted",
+        "chat_id": chat.id,
+        "letter_id": letter_id
+    })
+
     return None
 
 
@@ -306,7 +543,7 @@ def mark_as_read(
         chat_id: int,
         letter_id: int,
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
     chat = db.query(DATABASE.Chat).filter(DATABASE.Chat.id == chat_id).first()
     if not chat:
@@ -322,39 +559,28 @@ def mark_as_read(
     if not letter:
         raise HTTPException(status_code=404, detail="Letter not found")
 
+    if chat.user1_id != current_user.id and chat.user2_id != current_user.id:
+        raise HTTPException(
+            status_code=403,
+            detail="You are not a participant of this chat"
+        )
+
     if letter.author_id == current_user.id:
         raise HTTPException(
             status_code=400,
             detail="Cannot mark your own message as read"
         )
 
-    letter.is_read = True
-    db.commit()
-    db.refresh(letter)
+    if inbox.mark_read(db, chat_id, current_user.id, letter.id):
+        db.commit()
+        publish_read_event(db, chat, current_user.id)
 
-    return letter
+    return letter_response(letter, inbox.read_marks(db, chat_id))
 
 
 @letter.get("/unread/count", response_model=int)
 def get_unread_count(
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
-
-    chats = db.query(DATABASE.Chat).filter(
-        or_(
-            DATABASE.Chat.user1_id == current_user.id,
-            DATABASE.Chat.user2_id == current_user.id
-        )
-    ).all()
-
-    chat_ids = [chat.id for chat in chats]
-
-    unread_count = db.query(DATABASE.Letter).filter(
-        DATABASE.Letter.chat_id.in_(chat_ids),
-        DATABASE.Letter.author_id != current_user.id,
-        DATABASE.Letter.is_read == False
-    ).count()
-
-    return unread_count
-
+    return count_unread(db, current_user.id)
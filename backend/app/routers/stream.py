@@ -0,0 +1,128 @@
+import os
+from email.utils import parsedate_to_datetime
+
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Response
+from starlette.responses import FileResponse
+from sqlalchemy.orm import Session
+
+from .. import DATABASE, storage
+from ..db import get_db
+from ..timing import TimedRoute
+from ..cache import response_cache, video_tag
+
+# Размер одного чтения с диска и одного сообщения в сокет: память на ответ не зависит от размера файла
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(256 * 1024)))
+
+stream = APIRouter(prefix="/api/video", tags=["video"], route_class=TimedRoute)
+
+
+class VideoFileResponse(FileResponse):
+    """FileResponse со строгим ETag по содержимому, 304 на условные запросы и zero-copy, если сервер умеет.
+
+    Range, multi-range и If-Range обрабатывает сам Starlette, читая файл кусками по chunk_size.
+    """
+
+    chunk_size = STREAM_CHUNK_SIZE
+
+    def __init__(self, path: str, sha256: str, media_type: str):
+        super().__init__(path, media_type=media_type, headers={
+            "ETag": f'"{sha256}"',
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "public, max-age=86400",
+        })
+
+    async def __call__(self, scope, receive, send):
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                return await Response(status_code=404)(scope, receive, send)
+            self.set_stat_headers(self.stat_result)
+
+        if self._not_modified(scope):
+            headers = {key: self.headers[key] for key in ("etag", "last-modified", "cache-control")}
+            return await Response(status_code=304, headers=headers)(scope, receive, send)
+
+        request_headers = dict(scope["headers"])
+        if (
+            b"range" not in request_headers
+            and scope["method"] == "GET"
+            and "http.response.pathsend" in scope.get("extensions", {})
+        ):
+            # Сервер сам отправит файл (sendfile) — без чтения через Python
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+
+        await super().__call__(scope, receive, send)
+
+    def _not_modified(self, scope) -> bool:
+        request_headers = dict(scope["headers"])
+        if_none_match = request_headers.get(b"if-none-match")
+        if if_none_match is not None:
+            etag = self.headers["etag"]
+            tags = (tag.strip().removeprefix("W/") for tag in if_none_match.decode("latin-1").split(","))
+            return any(tag in (etag, "*") for tag in tags)
+
+        if_modified_since = request_headers.get(b"if-modified-since")
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since.decode("latin-1")).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(self.stat_result.st_mtime) <= since
+        return False
+
+    async def _handle_multiple_ranges(self, send, ranges, file_size, send_header_only):
+        async def send_with_content_type(message):
+            # Starlette 0.45 кладёт boundary в Content-Range, а по RFC 9110 он должен быть в Content-Type.
+            # Версии, где это исправлено, Content-Range не ставят — тогда заголовки не трогаем
+            if message["type"] == "http.response.start" and "content-range" in self.headers:
+                self.headers["content-type"] = self.headers["content-range"]
+                del self.headers["content-range"]
+                message = {**message, "headers": self.raw_headers}
+            await send(message)
+
+        await super()._handle_multiple_ranges(send_with_content_type, ranges, file_size, send_header_only)
+
+
+def stream_target(db: Session, video_uuid: str) -> tuple:
+    # Плеер при перемотке шлёт много Range-запросов подряд: путь к файлу кэшируем, а не ищем каждый раз в БД
+    key = ("stream", video_uuid)
+    target = response_cache.get(key)
+    if target is not None:
+        return target
+
+    version = response_cache.version
+    row = db.query(DATABASE.Video.id, DATABASE.StoredFile.sha256, DATABASE.StoredFile.content_type).join(
+        DATABASE.StoredFile, DATABASE.StoredFile.id == DATABASE.Video.file_id
+    ).filter(DATABASE.Video.uuid == video_uuid).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Video file not found")
+
+    video_id, sha256, content_type = row
+    target = (sha256, content_type or "video/mp4")
+    response_cache.set(key, target, tags=(video_tag(video_id),), version=version)
+    return target
+
+
+@stream.api_route("/{video_uuid}/stream", methods=["GET", "HEAD"])
+def stream_video(
+    video_uuid: str,
+    db: Session = Depends(get_db)
+):
+    sha256, content_type = stream_target(db, video_uuid)
+    return VideoFileResponse(storage.file_path(sha256), sha256, content_type)
+
+
+@stream.get("/{video_uuid}/poster")
+def video_poster(
+    video_uuid: str,
+    db: Session = Depends(get_db)
+):
+    sha256, _ = stream_target(db, video_uuid)
+    path = storage.poster_path(sha256)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Poster not found")
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
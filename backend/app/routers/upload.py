@@ -0,0 +1,215 @@
+import hashlib
+import os
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from sqlalchemy.orm import Session
+
+from .. import DATABASE, Pshemas, storage
+from ..db import get_db
+from ..timing import TimedRoute
+from ..authLOGIK import get_current_user, CurrentUser
+
+# Протокол: POST /api/uploads -> PUT /api/uploads/{id} кусками с заголовком Upload-Offset ->
+# POST /api/uploads/{id}/complete. После обрыва GET /api/uploads/{id} отдаёт подтверждённый offset.
+upload = APIRouter(prefix="/api/uploads", tags=["uploads"], route_class=TimedRoute)
+
+
+def upload_response(session: DATABASE.UploadSession) -> dict:
+    return {
+        "id": session.uuid,
+        "filename": session.filename,
+        "size": session.size,
+        "offset": session.offset,
+        "status": session.status,
+        "file": session.file,
+        "created_at": session.created_at,
+        "updated_at": session.updated_at
+    }
+
+
+def get_upload(db: Session, upload_id: str, user_id: int) -> DATABASE.UploadSession:
+    session = db.query(DATABASE.UploadSession).filter(
+        DATABASE.UploadSession.uuid == upload_id,
+        DATABASE.UploadSession.user_id == user_id
+    ).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+
+def _offset_conflict(detail: str, offset: int) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail=detail, headers={"Upload-Offset": str(offset)})
+
+
+@upload.post("", response_model=Pshemas.UploadSessionResponse, status_code=status.HTTP_201_CREATED)
+def create_upload(
+    upload_data: Pshemas.UploadCreate,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    session = DATABASE.UploadSession(
+        uuid=str(uuid.uuid4()),
+        user_id=current_user.id,
+        filename=upload_data.filename,
+        content_type=upload_data.content_type,
+        size=upload_data.size,
+        sha256=upload_data.sha256
+    )
+
+    if upload_data.sha256:
+        stored = storage.find_stored_file(db, upload_data.sha256)
+        # Без байтов — только свой файл: знание хэша чужого файла не даёт права его опубликовать.
+        # Остальные загружают содержимое, а store_file при завершении всё равно не хранит его дважды
+        if (
+            stored is not None
+            and stored.size == upload_data.size
+            and storage.owns_file(db, current_user.id, stored.id)
+            and os.path.exists(storage.file_path(stored.sha256))
+        ):
+            storage.check_quota(db, current_user.id, upload_data.size, counted=True)
+            session.status = "completed"
+            session.offset = stored.size
+            session.file = stored
+            db.add(session)
+            db.commit()
+            db.refresh(session)
+            return upload_response(session)
+
+    storage.check_quota(db, current_user.id, upload_data.size)
+    storage.create_partial(session.uuid)
+    db.add(session)
+    db.commit()
+    db.refresh(session)
+
+    return upload_response(session)
+
+
+@upload.get("/{upload_id}", response_model=Pshemas.UploadSessionResponse)
+def get_upload_status(
+    upload_id: uuid.UUID,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    upload_id = str(upload_id)
+    return upload_response(get_upload(db, upload_id, current_user.id))
+
+
+def _confirm_chunk(db: Session, session: DATABASE.UploadSession, offset: int) -> dict:
+    session.offset = offset
+    session.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(session)
+    return upload_response(session)
+
+
+def _write_block(f, digest, block: bytes) -> None:
+    f.write(block)
+    digest.update(block)
+
+
+def _finish_write(f, end: int) -> None:
+    # Хвост от прерванной попытки дальше подтверждённого offset не нужен
+    f.truncate(end)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+@upload.put("/{upload_id}", response_model=Pshemas.UploadSessionResponse)
+async def upload_chunk(
+    upload_id: uuid.UUID,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset", ge=0),
+    chunk_sha256: Optional[str] = Header(None, alias="X-Chunk-SHA256"),
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    """Дописывает кусок с позиции Upload-Offset. Тело читается потоком и сразу пишется на диск."""
+    upload_id = str(upload_id)
+    with storage.upload_lock(upload_id):
+        session = await run_in_threadpool(get_upload, db, upload_id, current_user.id)
+        if session.status != "uploading":
+            raise _offset_conflict("Upload is already completed", session.offset)
+        if upload_offset != session.offset:
+            raise _offset_conflict("Upload-Offset does not match the confirmed offset", session.offset)
+
+        remaining = session.size - session.offset
+        digest = hashlib.sha256()
+        written = 0
+        with open(storage.upload_path(upload_id), "r+b") as f:
+            f.seek(upload_offset)
+            try:
+                async for block in request.stream():
+                    if not block:
+                        continue
+                    written += len(block)
+                    if written > remaining:
+                        raise HTTPException(
+                            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail="Chunk goes past the declared upload size"
+                        )
+                    await run_in_threadpool(_write_block, f, digest, block)
+            except (ClientDisconnect, HTTPException):
+                # Неподтверждённые байты отбрасываем: клиент продолжит с session.offset
+                await run_in_threadpool(_finish_write, f, upload_offset)
+                raise
+
+            if chunk_sha256 and chunk_sha256.lower() != digest.hexdigest():
+                await run_in_threadpool(_finish_write, f, upload_offset)
+                raise HTTPException(status_code=400, detail="Chunk checksum mismatch")
+
+            await run_in_threadpool(_finish_write, f, upload_offset + written)
+
+        return await run_in_threadpool(_confirm_chunk, db, session, upload_offset + written)
+
+
+@upload.post("/{upload_id}/complete", response_model=Pshemas.UploadSessionResponse)
+def complete_upload(
+    upload_id: uuid.UUID,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    upload_id = str(upload_id)
+    with storage.upload_lock(upload_id):
+        session = get_upload(db, upload_id, current_user.id)
+        if session.status == "completed":
+            return upload_response(session)
+        if session.offset != session.size:
+            raise _offset_conflict("Upload is not finished yet", session.offset)
+
+        partial = storage.upload_path(upload_id)
+        sha256 = storage.hash_file(partial)
+        if session.sha256 and session.sha256 != sha256:
+            raise HTTPException(status_code=400, detail="File checksum mismatch")
+
+        stored = storage.store_file(db, partial, sha256, session.size, session.content_type)
+        session = get_upload(db, upload_id, current_user.id)
+        session.file_id = stored.id
+        session.status = "completed"
+        session.updated_at = datetime.utcnow()
+        db.commit()
+        db.refresh(session)
+        # Только после commit: если он сорвётся, клиент повторит complete с теми же байтами
+        storage.remove_upload_files(upload_id)
+
+    return upload_response(session)
+
+
+@upload.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+def cancel_upload(
+    upload_id: uuid.UUID,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    upload_id = str(upload_id)
+    with storage.upload_lock(upload_id):
+        session = get_upload(db, upload_id, current_user.id)
+        db.delete(session)
+        db.commit()
+        storage.remove_upload_files(upload_id)
+
+    return None
@@ -1,16 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import Optional, List
 
 from .. import DATABASE, Pshemas
-from ..db import get_db
+from ..db import get_db, get_async_db
+from ..timing import TimedRoute
+from ..loaders import video_loader
 from ..authLOGIK import (
-    authenticate_user, create_access_token, create_refresh_token,
-    save_token, revoke_token,
-    get_password_hash, SECRET_KEY, ALGORITHM, get_current_user
+    authenticate_user, issue_token_pair, revoke_token, revoke_family,
+    get_password_hash, SECRET_KEY, ALGORITHM, get_current_user, CurrentUser
 )
 
-users = APIRouter(prefix="/api/users", tags=["users"])
+users = APIRouter(prefix="/api/users", tags=["users"], route_class=TimedRoute)
 
 
 @users.get("/", response_model=List[Pshemas.UserResponse])
@@ -19,7 +21,7 @@ def get_all_users(
         skip: int = Query(0, ge=0),
         limit: int = Query(100, ge=1, le=100),
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
     query = db.query(DATABASE.User)
 
@@ -30,7 +32,7 @@ def get_all_users(
 def get_user(
     user_id: int,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     user = db.query(DATABASE.User).filter(DATABASE.User.id == user_id).first()
     if not user:
@@ -43,7 +45,7 @@ def get_user_history(
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=100),
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     if current_user.id != user_id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
@@ -54,7 +56,21 @@ def get_user_history(
         DATABASE.WatchHistory.watched_at.desc()
     ).offset(skip).limit(limit).all()
 
-    return history
+    # Названия видео всей страницы одним запросом
+    videos = video_loader(db).prime(entry.video_id for entry in history)
+
+    return [
+        {
+            "id": entry.id,
+            "video_id": entry.video_id,
+            "video_title": videos.get(entry.video_id).title,
+            "watched_at": entry.watched_at,
+            "watch_duration": entry.watch_duration,
+            "completed": entry.completed
+        }
+        for entry in history
+        if videos.get(entry.video_id) is not None
+    ]
 
 
 #------------auth-------------
@@ -63,11 +79,11 @@ from jose import JWTError, jwt
 from datetime import datetime
 
 @users.post("/auth/login", response_model=Pshemas.TokenPair)
-def login(
+async def login(
     login_data: Pshemas.LoginRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = authenticate_user(db, login_data.email, login_data.password)
+    user = await authenticate_user(db, login_data.email, login_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -81,17 +97,7 @@ def login(
             detail="Account is deactivated"
         )
 
-    access_token, access_expires = create_access_token({"sub": str(user.id)})
-    refresh_token, refresh_expires = create_refresh_token({"sub": str(user.id)})
-
-    save_token(db, access_token, "access", user.id, access_expires)
-    save_token(db, refresh_token, "refresh", user.id, refresh_expires)
-
-    return {
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "token_type": "bearer"
-    }
+    return await db.run_sync(issue_token_pair, user.id)
 
 @users.post("/auth/refresh", response_model=Pshemas.TokenPair)
 def refresh(
@@ -100,10 +106,25 @@ def refresh(
 ):
     refresh_token = refresh_data.refresh_token
 
+    try:
+        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id = payload.get("sub")
+        jti = payload.get("jti")
+        family_id = payload.get("fam")
+        if user_id is None or jti is None or family_id is None or payload.get("type") != "refresh":
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid refresh token"
+            )
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token"
+        )
+
     db_token = db.query(DATABASE.Token).filter(
-        DATABASE.Token.token == refresh_token,
-        DATABASE.Token.token_type == "refresh",
-        DATABASE.Token.is_revoked == False
+        DATABASE.Token.jti == jti,
+        DATABASE.Token.token_type == "refresh"
     ).first()
 
     if not db_token:
@@ -113,50 +134,28 @@ def refresh(
         )
 
     if db_token.expires_at < datetime.utcnow():
-        db_token.is_revoked = True
-        db.commit()
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Refresh token expired"
         )
 
-    try:
-        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid refresh token"
-            )
-    except JWTError:
+    # Условный UPDATE: из параллельных refresh одним токеном выигрывает только один
+    claimed = db.query(DATABASE.Token).filter(
+        DATABASE.Token.id == db_token.id,
+        DATABASE.Token.is_revoked == False
+    ).update({"is_revoked": True}, synchronize_session=False)
+
+    if not claimed:
+        # Уже использованный refresh-токен предъявлен повторно — считаем семейство скомпрометированным
+        revoke_family(db, family_id, int(user_id))
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid refresh token"
         )
 
-    old_access_tokens = db.query(DATABASE.Token).filter(
-        DATABASE.Token.user_id == user_id,
-        DATABASE.Token.token_type == "access",
-        DATABASE.Token.is_revoked == False
-    ).all()
-
-    for token in old_access_tokens:
-        token.is_revoked = True
-
-    access_token, access_expires = create_access_token({"sub": user_id})
-    new_refresh_token, refresh_expires = create_refresh_token({"sub": user_id})
-
-    save_token(db, access_token, "access", int(user_id), access_expires)
-    save_token(db, new_refresh_token, "refresh", int(user_id), refresh_expires)
-
-    db_token.is_revoked = True
-    db.commit()
-
-    return {
-        "access_token": access_token,
-        "refresh_token": new_refresh_token,
-        "token_type": "bearer"
-    }
+    # Старые access и refresh этого входа отзываются одним UPDATE, новая пара остаётся в том же семействе
+    revoke_family(db, family_id, int(user_id))
+    return issue_token_pair(db, int(user_id), family_id)
 
 @users.post("/auth/logout")
 def logout_user(refresh_data: Pshemas.RefreshRequest,
@@ -167,29 +166,25 @@ def logout_user(refresh_data: Pshemas.RefreshRequest,
 
 @users.get("/auth/me", response_model=Pshemas.UserResponse)
 def get_me(
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     return current_user
 
 
-@users.post("/register", response_model=Pshemas.UserResponse, status_code=status.HTTP_201_CREATED)
-def register(
-        user_data: Pshemas.UserCreate,
-        db: Session = Depends(get_db)
-):
-    existing_email = db.query(DATABASE.User).filter(
-        DATABASE.User.email == user_data.email
-    ).first()
+def check_registration(db: Session, email: str, username: str) -> None:
+    existing_email = db.query(DATABASE.User.id).filter(DATABASE.User.email == email).first()
     if existing_email:
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    existing_username = db.query(DATABASE.User).filter(
-        DATABASE.User.username == user_data.username
-    ).first()
+    existing_username = db.query(DATABASE.User.id).filter(DATABASE.User.username == username).first()
     if existing_username:
         raise HTTPException(status_code=400, detail="Username already taken")
 
-    hashed_password = get_password_hash(user_data.password)
+    # Соединение возвращается в пул на время хеширования
+    db.rollback()
+
+
+def create_user(db: Session, user_data: Pshemas.UserCreate, hashed_password: str) -> Pshemas.UserResponse:
     db_user = DATABASE.User(
         email=user_data.email,
         username=user_data.username,
@@ -198,5 +193,14 @@ def register(
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    return Pshemas.UserResponse.model_validate(db_user)
+
 
-    return db_user
\ No newline at end of file
+@users.post("/register", response_model=Pshemas.UserResponse, status_code=status.HTTP_201_CREATED)
+async def register(
+        user_data: Pshemas.UserCreate,
+        db: AsyncSession = Depends(get_async_db)
+):
+    await db.run_sync(check_registration, user_data.email, user_data.username)
+    hashed_password = await get_password_hash(user_data.password)
+    return await db.run_sync(create_user, user_data, hashed_password)
\ No newline at end of file
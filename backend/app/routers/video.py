@@ -1,80 +1,142 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 from typing import List, Optional
+import json
+import tempfile
 import uuid
 from datetime import datetime
 
 
 from .. import DATABASE, Pshemas
-from ..db import get_db
-from ..authLOGIK import get_current_user
+from ..db import get_db, get_async_db
+from ..timing import TimedRoute
+from ..authLOGIK import get_current_user, CurrentUser
+from ..pagination import encode_cursor, decode_cursor, keyset_filter
+from ..search import video_filter, search_videos
+from ..viewcounter import view_counter
+from ..jobs import enqueue_processing
+from ..loaders import user_loader
+from ..importer import BULK_IMPORT_BATCH_SIZE, insert_batch, ndjson_lines, url_hash
+from ..cache import response_cache, CachedResponse, cached_response, CATALOG_TAG, video_tag
 
 def create_id() -> str:
     return str(uuid.uuid4())
 
-video = APIRouter(prefix="/api/video", tags=["video"])
+video = APIRouter(prefix="/api/video", tags=["video"], route_class=TimedRoute)
+
+
+def video_list_items(db: Session, videos: List[DATABASE.Video]) -> List[dict]:
+    # Авторы всей страницы одним запросом, а не video.author на каждую строку
+    authors = user_loader(db).prime(video.author_id for video in videos)
+    return [video_list_item(video, authors.get(video.author_id).username) for video in videos]
+
+
+def video_list_item(video: DATABASE.Video, author_name: str) -> dict:
+    return {
+        "id": video.id,
+        "uuid": video.uuid,
+        "title": video.title,
+        "thumbnail_url": video.thumbnail_url,
+        "duration": video.duration,
+        "author_name": author_name,
+        "views_count": video.views_count,
+        "created_at": video.created_at,
+        "comments_count": video.comments_count
+    }
+
+
+catalog_adapter = TypeAdapter(List[Pshemas.VideoListResponse])
+video_adapter = TypeAdapter(Pshemas.VideoResponse)
+
+
+def build_catalog_page(
+    db: Session,
+    skip: int,
+    limit: int,
+    sort_by: str,
+    order: str,
+    search: Optional[str],
+    cursor: Optional[str]
+) -> CachedResponse:
+    sort_column = getattr(DATABASE.Video, sort_by)
+    query = db.query(DATABASE.Video)
+
+    if search:
+        query = query.filter(video_filter(db, search))
+
+    if order == "desc":
+        query = query.order_by(sort_column.desc(), DATABASE.Video.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), DATABASE.Video.id.asc())
+
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort_by, order)
+        query = query.filter(keyset_filter(sort_column, DATABASE.Video.id, order, value, last_id))
+    else:
+        query = query.offset(skip)
+
+    # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+    page = query.limit(limit + 1).all()
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    headers = {}
+    if has_more:
+        last = page[-1]
+        headers["X-Next-Cursor"] = encode_cursor(sort_by, order, getattr(last, sort_by), last.id)
+
+    return CachedResponse(catalog_adapter, video_list_items(db, page), headers)
+
+
+def warm_catalog_cache(db: Session, pages: int, limit: int = 20) -> None:
+    for page in range(pages):
+        key = ("catalog", page * limit, limit, "created_at", "desc", None, None)
+        response_cache.set(key, build_catalog_page(db, page * limit, limit, "created_at", "desc", None, None),
+                           tags=(CATALOG_TAG,))
+
 
 @video.get("/", response_model=List[Pshemas.VideoListResponse])
-def get_list_video_lessen(
+async def get_list_video_lessen(
+    request: Request,
     skip: int = Query(0, ge=0),
     limit: int = Query(20, ge=1, le=100),
     sort_by: str = Query("created_at", regex="^(created_at|views_count|title)$"),
     order: str = Query("desc", regex="^(asc|desc)$"),
     search: Optional[str] = None,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="next_cursor из заголовка X-Next-Cursor предыдущей страницы"),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(
-        DATABASE.Video,
-        func.count(DATABASE.Comment.id).label('comments_count')
-    ).outerjoin(
-        DATABASE.Comment, DATABASE.Comment.video_id == DATABASE.Video.id
-    ).group_by(DATABASE.Video.id)
+    search = search or None
+    cursor = cursor or None
+    key = ("catalog", 0 if cursor else skip, limit, sort_by, order, search, cursor)
 
-    if search:
-        query = query.filter(DATABASE.Video.title.ilike(f"%{search}%"))
+    entry = response_cache.get(key)
+    if entry is None:
+        version = response_cache.version
+        entry = await db.run_sync(build_catalog_page, skip, limit, sort_by, order, search, cursor)
+        response_cache.set(key, entry, tags=(CATALOG_TAG,), version=version)
 
-    if order == "desc":
-        query = query.order_by(getattr(DATABASE.Video, sort_by).desc())
-    else:
-        query = query.order_by(getattr(DATABASE.Video, sort_by).asc())
-
-    results = query.offset(skip).limit(limit).all()
-
-    videos = []
-    for video, comments_count in results:
-        video_dict = {
-            "id": video.id,
-            "uuid": video.uuid,
-            "title": video.title,
-            "thumbnail_url": video.thumbnail_url,
-            "duration": video.duration,
-            "author_name": video.author.username,
-            "views_count": video.views_count,
-            "created_at": video.created_at,
-            "comments_count": comments_count
-        }
-        videos.append(video_dict)
+    return cached_response(request, entry)
 
-    return videos
 
-@video.get("/{video_id}", response_model=Pshemas.VideoResponse)
-def get_video_lessen(
-    video_id: int,
+@video.get("/search", response_model=List[Pshemas.VideoListResponse])
+def search_video_lessen(
+    q: str = Query(..., min_length=1, max_length=200),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
     db: Session = Depends(get_db)
 ):
-    video = db.query(DATABASE.Video).filter(DATABASE.Video.id == video_id).first()
-    if not video:
-        raise HTTPException(status_code=404, detail="Video not found")
-
-    video.views_count += 1
-    db.commit()
+    return video_list_items(db, search_videos(db, q, skip, limit))
 
-    comments_count = db.query(DATABASE.Comment).filter(
-        DATABASE.Comment.video_id == video_id
-    ).count()
-
-    response = Pshemas.VideoResponse(
+def video_response(video: DATABASE.Video, author_name: str) -> Pshemas.VideoResponse:
+    return Pshemas.VideoResponse(
         id=video.id,
         uuid=video.uuid,
         title=video.title,
@@ -83,38 +145,95 @@ def get_video_lessen(
         thumbnail_url=video.thumbnail_url,
         duration=video.duration,
         author_id=video.author_id,
-        author_name=video.author.username,
+        author_name=author_name,
         views_count=video.views_count,
         likes_count=video.likes_count,
         created_at=video.created_at,
         updated_at=video.updated_at,
-        comments_count=comments_count
+        comments_count=video.comments_count,
+        processing_status=video.processing_status
     )
 
-    return response
+
+def build_video_entry(db: Session, video_id: int) -> CachedResponse:
+    video = db.query(DATABASE.Video).filter(DATABASE.Video.id == video_id).first()
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    return CachedResponse(video_adapter, video_response(video, user_loader(db).get(video.author_id).username))
+
+
+@video.get("/{video_id}", response_model=Pshemas.VideoResponse)
+async def get_video_lessen(
+    video_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_async_db)
+):
+    key = ("video", video_id)
+    entry = response_cache.get(key)
+    if entry is None:
+        version = response_cache.version
+        entry = await db.run_sync(build_video_entry, video_id)
+        response_cache.set(key, entry, tags=(video_tag(video_id),), version=version)
+
+    # Просмотр копится в памяти и пишется в БД пачкой, сам запрос остаётся чистым чтением
+    view_counter.add(video_id)
+
+    return cached_response(request, entry)
+
+
+def imported_video(db: Session, author_id: int, digest: str) -> Optional[DATABASE.Video]:
+    return db.query(DATABASE.Video).filter(
+        DATABASE.Video.author_id == author_id,
+        DATABASE.Video.url_hash == digest
+    ).first()
 
 
 #Импортировать видео (сохранить ссылку на существующее видео)
-@video.post("/import", response_model=Pshemas.VideoResponse, status_code=status.HTTP_201_CREATED)
+@video.post(
+    "/import",
+    response_model=Pshemas.VideoResponse,
+    status_code=status.HTTP_201_CREATED,
+    responses={200: {"model": Pshemas.VideoResponse,
+                     "description": "Эта ссылка у автора уже импортирована — возвращается то же видео"}}
+)
 def import_video_lessen(
     video_data: Pshemas.VideoCreate,
+    response: Response,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
+    digest = url_hash(video_data.video_url)
+    # Повторный импорт той же ссылки идемпотентен: клиенты, которые его повторяют, получают то же видео, а не ошибку
+    existing = imported_video(db, current_user.id, digest)
+    if existing is not None:
+        response.status_code = status.HTTP_200_OK
+        return video_response(existing, current_user.username)
 
     new_video = DATABASE.Video(
         uuid=create_id(),
         title=video_data.title,
         description=video_data.description,
         video_url=video_data.video_url,
+        url_hash=digest,
         thumbnail_url=video_data.thumbnail_url,
         duration=video_data.duration,
         author_id=current_user.id
     )
 
     db.add(new_video)
+    try:
+        db.flush()
+    except IntegrityError:
+        # Ту же ссылку одновременно импортировал параллельный запрос
+        db.rollback()
+        response.status_code = status.HTTP_200_OK
+        return video_response(imported_video(db, current_user.id, digest), current_user.username)
+    # Длительность и превью посчитает воркер (python -m app.manage worker)
+    enqueue_processing(db, new_video)
     db.commit()
     db.refresh(new_video)
+    response_cache.invalidate(CATALOG_TAG)
 
     return Pshemas.VideoResponse(
         id=new_video.id,
@@ -130,30 +249,104 @@ def import_video_lessen(
         likes_count=0,
         created_at=new_video.created_at,
         updated_at=new_video.updated_at,
-        comments_count=0
+        comments_count=0,
+        processing_status=new_video.processing_status
     )
 
 
+#Импорт каталога одним запросом: тело — NDJSON, по строке Pshemas.VideoCreate на видео
+@video.post("/import/bulk")
+async def bulk_import_video_lessen(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    # Отчёт по строкам копится во временном файле и отдаётся потоком: память не растёт с размером импорта
+    report = tempfile.TemporaryFile()
+    summary = {"created": 0, "duplicate": 0, "invalid": 0}
+    batch = []
+    # Ошибки строк ждут вставки своей пачки, чтобы отчёт шёл в порядке строк
+    rejected = []
+
+    def reject(line_number: int, errors: list) -> None:
+        rejected.append({"line": line_number, "status": "invalid", "errors": errors})
+
+    async def flush() -> None:
+        results = await run_in_threadpool(insert_batch, db, current_user.id, batch) if batch else []
+        for result in sorted(results + rejected, key=lambda result: result["line"]):
+            summary[result["status"]] += 1
+            report.write(json.dumps(result).encode() + b"\n")
+        batch.clear()
+        rejected.clear()
+
+    try:
+        line_number = 0
+        async for line in ndjson_lines(request.stream()):
+            line_number += 1
+            if line is None:
+                reject(line_number, [{"type": "too_long", "loc": [], "msg": "Line is too long"}])
+            elif line.strip():
+                try:
+                    batch.append((line_number, Pshemas.VideoCreate.model_validate_json(line)))
+                except ValidationError as e:
+                    reject(line_number, e.errors(include_url=False, include_context=False, include_input=False))
+            if len(batch) + len(rejected) >= BULK_IMPORT_BATCH_SIZE:
+                await flush()
+        await flush()
+    except BaseException:
+        report.close()
+        raise
+
+    if summary["created"]:
+        response_cache.invalidate(CATALOG_TAG)
+
+    report.write(json.dumps({"summary": summary}).encode() + b"\n")
+    report.seek(0)
+    return StreamingResponse(
+        iterate_in_threadpool(_read_report(report)),
+        media_type="application/x-ndjson"
+    )
+
+
+def _read_report(report):
+    with report:
+        yield from report
+
+
 @video.post("/upload", response_model=Pshemas.VideoResponse, status_code=status.HTTP_201_CREATED)
 def upload_video_lessen(
-    video_data: Pshemas.VideoCreate,
+    video_data: Pshemas.VideoUpload,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
-    # Здесь будет логика загрузки файлов, я бы хотела загружать файлы прямо с личного компьютера
+    # Файл уже загружен через /api/uploads; привязать можно только файл из своей завершённой загрузки
+    upload = db.query(DATABASE.UploadSession).filter(
+        DATABASE.UploadSession.user_id == current_user.id,
+        DATABASE.UploadSession.file_id == video_data.file_id,
+        DATABASE.UploadSession.status == "completed"
+    ).first()
+    if not upload:
+        raise HTTPException(status_code=404, detail="Uploaded file not found")
+
+    video_uuid = create_id()
     new_video = DATABASE.Video(
-        uuid=create_id(),
+        uuid=video_uuid,
         title=video_data.title,
         description=video_data.description,
-        video_url=video_data.video_url,  # Это будет URL загруженного файла
+        video_url=f"/api/video/{video_uuid}/stream",
         thumbnail_url=video_data.thumbnail_url,
         duration=video_data.duration,
-        author_id=current_user.id
+        author_id=current_user.id,
+        file_id=video_data.file_id
     )
 
     db.add(new_video)
+    db.flush()
+    # Длительность и превью посчитает воркер (python -m app.manage worker)
+    enqueue_processing(db, new_video)
     db.commit()
     db.refresh(new_video)
+    response_cache.invalidate(CATALOG_TAG)
 
     return Pshemas.VideoResponse(
         id=new_video.id,
@@ -169,14 +362,15 @@ def upload_video_lessen(
         likes_count=0,
         created_at=new_video.created_at,
         updated_at=new_video.updated_at,
-        comments_count=0
+        comments_count=0,
+        processing_status=new_video.processing_status
     )
 
 @video.delete("/{video_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_video_lessen(
     video_id: int,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     video = db.query(DATABASE.Video).filter(DATABASE.Video.id == video_id).first()
 
@@ -191,6 +385,7 @@ def delete_video_lessen(
 
     db.delete(video)
     db.commit()
+    response_cache.invalidate(CATALOG_TAG, video_tag(video_id))
 
     return None
 
@@ -199,7 +394,7 @@ def update_video_lessen(
     video_id: int,
     video_data: Pshemas.VideoUpdate,
     db: Session = Depends(get_db),
-    current_user: DATABASE.User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     video = db.query(DATABASE.Video).filter(DATABASE.Video.id == video_id).first()
 
@@ -219,10 +414,7 @@ def update_video_lessen(
     video.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(video)
-
-    comments_count = db.query(DATABASE.Comment).filter(
-        DATABASE.Comment.video_id == video_id
-    ).count()
+    response_cache.invalidate(CATALOG_TAG, video_tag(video_id))
 
     return Pshemas.VideoResponse(
         id=video.id,
@@ -238,8 +430,37 @@ def update_video_lessen(
         likes_count=video.likes_count,
         created_at=video.created_at,
         updated_at=video.updated_at,
-        comments_count=comments_count
+        comments_count=video.comments_count,
+        processing_status=video.processing_status
+    )
+
+
+def upsert_watch_history(db: Session, user_id: int, events: List[Pshemas.WatchHistoryCreate]) -> None:
+    # Одна запись на (user_id, video_id): INSERT ... ON CONFLICT DO UPDATE вместо SELECT + UPDATE/INSERT
+    dialect = db.get_bind().dialect.name
+    insert = postgresql_insert if dialect == "postgresql" else sqlite_insert
+
+    now = datetime.utcnow()
+    statement = insert(DATABASE.WatchHistory.__table__).values([
+        {
+            "user_id": user_id,
+            "video_id": event.video_id,
+            "watch_duration": event.watch_duration,
+            "completed": event.completed,
+            "watched_at": now,
+        }
+        for event in events
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id", "video_id"],
+        set_={
+            "watch_duration": statement.excluded.watch_duration,
+            "completed": statement.excluded.completed,
+            "watched_at": statement.excluded.watched_at,
+        }
     )
+    db.execute(statement)
+    db.commit()
 
 
 @video.post("/{video_id}/watch", status_code=status.HTTP_200_OK)
@@ -247,30 +468,43 @@ def track_watch(
         video_id: int,
         watch_data: Pshemas.WatchHistoryCreate,
         db: Session = Depends(get_db),
-        current_user: DATABASE.User = Depends(get_current_user)
+        current_user: CurrentUser = Depends(get_current_user)
 ):
-    video = db.query(DATABASE.Video).filter(DATABASE.Video.id == video_id).first()
-    if not video:
+    exists = db.query(DATABASE.Video.id).filter(DATABASE.Video.id == video_id).first()
+    if not exists:
         raise HTTPException(status_code=404, detail="Video not found")
 
-    existing = db.query(DATABASE.WatchHistory).filter(
-        DATABASE.WatchHistory.user_id == current_user.id,
-        DATABASE.WatchHistory.video_id == video_id
-    ).first()
-
-    if existing:
-        existing.watch_duration = watch_data.watch_duration
-        existing.completed = watch_data.completed
-        existing.watched_at = datetime.utcnow()
-    else:
-        history = DATABASE.WatchHistory(
-            user_id=current_user.id,
+    upsert_watch_history(db, current_user.id, [
+        Pshemas.WatchHistoryCreate(
             video_id=video_id,
             watch_duration=watch_data.watch_duration,
             completed=watch_data.completed
         )
-        db.add(history)
+    ])
+
+    return {"message": "Watch history updated"}
 
-    db.commit()
 
-    return {"message": "Watch history updated"}
\ No newline at end of file
+@video.post("/watch/batch", response_model=Pshemas.WatchBatchResponse)
+def track_watch_batch(
+        batch: Pshemas.WatchBatchCreate,
+        db: Session = Depends(get_db),
+        current_user: CurrentUser = Depends(get_current_user)
+):
+    # Из нескольких событий по одному видео остаётся последнее
+    latest = {}
+    for event in batch.events:
+        latest[event.video_id] = event
+
+    existing_ids = {
+        video_id for (video_id,) in db.query(DATABASE.Video.id).filter(
+            DATABASE.Video.id.in_(list(latest))
+        ).all()
+    }
+    skipped = sorted(video_id for video_id in latest if video_id not in existing_ids)
+    events = [event for video_id, event in latest.items() if video_id in existing_ids]
+
+    if events:
+        upsert_watch_history(db, current_user.id, events)
+
+    return {"accepted": len(events), "skipped_video_ids": skipped}
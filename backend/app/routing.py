@@ -0,0 +1,115 @@
+"""Чтение с реплик БД (DATABASE_REPLICA_URLS).
+
+ReadRoutingMiddleware разрешает сессиям HTTP-запроса читать с реплики, если это GET/HEAD и
+пользователь (sub из токена) ничего не записывал последние DATABASE_REPLICA_STICKY_SECONDS
+секунд: иначе, пока реплика отстаёт, он не увидел бы собственный комментарий или письмо.
+Запись всегда идёт в основную БД (db.RoutingSession), и после первой записи сессия читает
+оттуда же. Обработчик GET, который читает и по прочитанному решает, что записать,
+подключает Depends(use_primary).
+
+Отметки о записи хранятся в памяти процесса: с несколькими воркерами uvicorn следующий
+запрос может попасть в другой процесс, и окно нужно брать с запасом на отставание реплики.
+"""
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from jose import JWTError, jwt
+from starlette.datastructures import Headers
+
+DATABASE_REPLICA_STICKY_SECONDS = float(os.getenv("DATABASE_REPLICA_STICKY_SECONDS", "5"))
+
+READ_METHODS = {"GET", "HEAD"}
+
+
+class ReadRouting:
+    __slots__ = ("replica", "wrote")
+
+    def __init__(self, replica: bool):
+        self.replica = replica
+        self.wrote = False
+
+
+_current: ContextVar[Optional[ReadRouting]] = ContextVar("read_routing", default=None)
+
+
+def replica_allowed() -> bool:
+    routing = _current.get()
+    return routing is not None and routing.replica
+
+
+def note_write() -> None:
+    routing = _current.get()
+    if routing is not None:
+        routing.replica = False
+        routing.wrote = True
+
+
+async def use_primary() -> None:
+    """Зависимость для GET-обработчиков, которым нельзя читать с реплики."""
+    routing = _current.get()
+    if routing is not None:
+        routing.replica = False
+
+
+class RecentWriters:
+    def __init__(self, window: float, max_size: int = 100_000):
+        self.window = window
+        self.max_size = max_size
+        self._until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def mark(self, subject: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if len(self._until) >= self.max_size:
+                self._until = {key: until for key, until in self._until.items() if until > now}
+            self._until[subject] = now + self.window
+
+    def active(self, subject: str) -> bool:
+        until = self._until.get(subject)
+        return until is not None and until > time.monotonic()
+
+
+recent_writers = RecentWriters(DATABASE_REPLICA_STICKY_SECONDS)
+
+
+def request_subject(scope) -> Optional[str]:
+    # Подпись не проверяем: sub нужен только для выбора БД, а подделав его, клиент лишь отправит свои чтения в основную
+    authorization = Headers(scope=scope).get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        subject = jwt.get_unverified_claims(token).get("sub")
+    except JWTError:
+        return None
+    return str(subject) if subject is not None else None
+
+
+class ReadRoutingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        subject = request_subject(scope)
+        routing = ReadRouting(scope["method"] in READ_METHODS and not (subject and recent_writers.active(subject)))
+
+        async def send_marking_writer(message):
+            # Отмечаем до отправки ответа: следующий запрос клиента может прийти раньше, чем завершится этот
+            if message["type"] == "http.response.start" and routing.wrote:
+                recent_writers.mark(subject)
+            await send(message)
+
+        token = _current.set(routing)
+        try:
+            await self.app(scope, receive, send_marking_writer if subject else send)
+        finally:
+            _current.reset(token)
+            if subject and routing.wrote:
+                recent_writers.mark(subject)
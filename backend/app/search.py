@@ -0,0 +1,238 @@
+"""Полнотекстовый поиск по видео и по письмам.
+
+Postgres: GIN-индекс по выражению tsvector (title с весом A, description с весом B)
+и триграммный индекс по title; для писем — GIN по tsvector(content). Все индексы
+по выражениям, поэтому PostgreSQL поддерживает их сам при любых INSERT/UPDATE/DELETE.
+
+SQLite: FTS5-таблицы video_search и letter_search с внешним содержимым (content='videos',
+content='letters'), синхронизируются триггерами — так же в одной транзакции с изменением строк.
+"""
+import html
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Float, cast, column, func, literal_column, or_, select, table, text, tuple_
+from sqlalchemy.orm import Session
+
+from . import DATABASE
+from .pagination import decode_cursor, encode_cursor
+
+MAX_TERMS = 8
+
+# Одно и то же выражение используется в индексе и в запросах, иначе планировщик не возьмёт индекс
+VIDEO_DOCUMENT_SQL = (
+    "(setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'B'))"
+)
+
+LETTER_DOCUMENT_SQL = "to_tsvector('simple', content)"
+
+# Границы совпадения в сниппете: символы из Private Use Area, в тексте писем их не бывает.
+# После html.escape они заменяются на <mark>, поэтому сниппет безопасно вставлять как HTML.
+MARK_START = "\ue000"
+MARK_END = "\ue001"
+SNIPPET_WORDS = 16
+
+_POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS idx_video_search ON videos USING gin ({VIDEO_DOCUMENT_SQL})",
+    "CREATE INDEX IF NOT EXISTS idx_video_title_trgm ON videos USING gin (title gin_trgm_ops)",
+    f"CREATE INDEX IF NOT EXISTS idx_letter_search ON letters USING gin ({LETTER_DOCUMENT_SQL})",
+]
+
+_SQLITE_VIDEO_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS video_search USING fts5("
+    "title, description, content='videos', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS video_search_ai AFTER INSERT ON videos BEGIN "
+    "INSERT INTO video_search(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS video_search_ad AFTER DELETE ON videos BEGIN "
+    "INSERT INTO video_search(video_search, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS video_search_au AFTER UPDATE OF title, description ON videos BEGIN "
+    "INSERT INTO video_search(video_search, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO video_search(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+]
+
+_SQLITE_LETTER_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS letter_search USING fts5("
+    "content, content='letters', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS letter_search_ai AFTER INSERT ON letters BEGIN "
+    "INSERT INTO letter_search(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS letter_search_ad AFTER DELETE ON letters BEGIN "
+    "INSERT INTO letter_search(letter_search, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS letter_search_au AFTER UPDATE OF content ON letters BEGIN "
+    "INSERT INTO letter_search(letter_search, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO letter_search(rowid, content) VALUES (new.id, new.content); END",
+]
+
+_SQLITE_DDL = {"video_search": _SQLITE_VIDEO_DDL, "letter_search": _SQLITE_LETTER_DDL}
+
+video_search = table("video_search", column("rowid"))
+letter_search = table("letter_search", column("rowid"))
+
+
+def setup(engine) -> None:
+    """Создаёт поисковые индексы, если их ещё нет. Вызывается при старте после create_all."""
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            for statement in _POSTGRES_DDL:
+                conn.execute(text(statement))
+        elif engine.dialect.name == "sqlite":
+            for name, statements in _SQLITE_DDL.items():
+                exists = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": name}
+                ).first()
+                for statement in statements:
+                    conn.execute(text(statement))
+                if not exists:
+                    conn.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+
+
+def rebuild(db: Session) -> None:
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        db.execute(text("REINDEX INDEX idx_video_search"))
+        db.execute(text("REINDEX INDEX idx_video_title_trgm"))
+        db.execute(text("REINDEX INDEX idx_letter_search"))
+    elif dialect == "sqlite":
+        for name in _SQLITE_DDL:
+            db.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+    db.commit()
+
+
+def _terms(term: str) -> List[str]:
+    return [word.lower() for word in re.findall(r"\w+", term)][:MAX_TERMS]
+
+
+def _fts5_query(terms: List[str]) -> str:
+    # Каждое слово в кавычках и с * — префиксный поиск без синтаксиса FTS5 от пользователя
+    return " ".join(f'"{word}"*' for word in terms)
+
+
+def _tsquery(terms: List[str]):
+    return func.to_tsquery(literal_column("'simple'"), " & ".join(f"{word}:*" for word in terms))
+
+
+def _ranked_matches(db: Session, term: str):
+    """Подзапрос (video_id, rank) — чем меньше rank, тем выше релевантность."""
+    terms = _terms(term)
+    if not terms:
+        return None
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        return (
+            select(
+                video_search.c.rowid.label("video_id"),
+                func.bm25(literal_column("video_search"), 10.0, 1.0).label("rank"),
+            )
+            .select_from(video_search)
+            .where(literal_column("video_search").op("MATCH")(_fts5_query(terms)))
+            .subquery()
+        )
+
+    document = literal_column(VIDEO_DOCUMENT_SQL)
+    query = _tsquery(terms)
+    return (
+        select(
+            DATABASE.Video.id.label("video_id"),
+            (-func.ts_rank(document, query)).label("rank"),
+        )
+        .where(document.op("@@")(query) | DATABASE.Video.title.ilike(f"%{_like_escape(term)}%", escape="\\"))
+        .subquery()
+    )
+
+
+def _like_escape(term: str) -> str:
+    # % и _ в запросе — обычные символы, а не шаблон на все названия
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def video_filter(db: Session, term: str):
+    """Условие для каталога: видео, подходящие под поисковую строку."""
+    matches = _ranked_matches(db, term)
+    if matches is None:
+        return DATABASE.Video.id.is_(None)
+    return DATABASE.Video.id.in_(select(matches.c.video_id))
+
+
+def search_videos(db: Session, term: str, skip: int, limit: int) -> List[DATABASE.Video]:
+    matches = _ranked_matches(db, term)
+    if matches is None:
+        return []
+
+    return (
+        db.query(DATABASE.Video)
+        .join(matches, matches.c.video_id == DATABASE.Video.id)
+        .order_by(matches.c.rank, DATABASE.Video.created_at.desc(), DATABASE.Video.id.desc())
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
+
+
+def highlight(snippet: str) -> str:
+    return html.escape(snippet).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+def search_letters(db: Session, user_id: int, term: str, limit: int, cursor: Optional[str] = None,
+                   chat_id: Optional[int] = None) -> Tuple[list, Optional[str]]:
+    """Письма из чатов пользователя по релевантности: [(letter, author, snippet)] и курсор следующей страницы.
+
+    Курсор — (rank, id) последней строки; rank зависит от статистики индекса,
+    поэтому при активной переписке соседние страницы могут немного сдвинуться.
+    """
+    terms = _terms(term)
+    if not terms:
+        return [], None
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        rank = func.bm25(literal_column("letter_search"))
+        snippet = func.snippet(
+            literal_column("letter_search"), 0, MARK_START, MARK_END, "…", SNIPPET_WORDS
+        )
+        query = (
+            db.query(DATABASE.Letter, DATABASE.User, snippet, rank)
+            .select_from(letter_search)
+            .join(DATABASE.Letter, DATABASE.Letter.id == letter_search.c.rowid)
+            .filter(literal_column("letter_search").op("MATCH")(_fts5_query(terms)))
+        )
+    else:
+        document = func.to_tsvector(literal_column("'simple'"), DATABASE.Letter.content)
+        tsquery = _tsquery(terms)
+        # ts_rank — real (float4): в курсоре он проходит через JSON как double и при сравнении с пересчитанным
+        # float4 уже не равен ему, строки на границе страницы терялись или повторялись. В float8 совпадает точно
+        rank = cast(-func.ts_rank(document, tsquery), Float(53))
+        snippet = func.ts_headline(
+            literal_column("'simple'"), DATABASE.Letter.content, tsquery,
+            f'StartSel="{MARK_START}", StopSel="{MARK_END}", MaxWords={SNIPPET_WORDS}, MinWords=5'
+        )
+        query = (
+            db.query(DATABASE.Letter, DATABASE.User, snippet, rank)
+            .filter(document.op("@@")(tsquery))
+        )
+
+    query = query.join(
+        DATABASE.Chat, DATABASE.Chat.id == DATABASE.Letter.chat_id
+    ).join(
+        DATABASE.User, DATABASE.User.id == DATABASE.Letter.author_id
+    ).filter(
+        or_(DATABASE.Chat.user1_id == user_id, DATABASE.Chat.user2_id == user_id)
+    )
+    if chat_id is not None:
+        query = query.filter(DATABASE.Letter.chat_id == chat_id)
+    if cursor:
+        cursor_rank, cursor_id = decode_cursor(cursor, "rank", "asc")
+        query = query.filter(tuple_(rank, DATABASE.Letter.id) > tuple_(cursor_rank, cursor_id))
+
+    rows = query.order_by(rank, DATABASE.Letter.id).limit(limit).all()
+
+    next_cursor = None
+    if len(rows) == limit:
+        last_letter, _, _, last_rank = rows[-1]
+        next_cursor = encode_cursor("rank", "asc", last_rank, last_letter.id)
+    return [(letter, author, highlight(fragment)) for letter, author, fragment, _ in rows], next_cursor
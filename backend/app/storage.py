@@ -0,0 +1,269 @@
+"""Файлы видео на локальном диске.
+
+MEDIA_ROOT/uploads/<uuid>.part — незавершённые загрузки,
+MEDIA_ROOT/files/ab/cd/<sha256> — готовые файлы, по одному на содержимое,
+MEDIA_ROOT/posters/ab/<sha256>.jpg — кадры-превью, которые строит воркер (app.jobs).
+
+Строку stored_files, которую переиспользуют, держат FOR SHARE до commit ссылки на неё,
+а сборщик мусора удаляет файл под FOR UPDATE — так он не сотрёт только что взятый файл.
+В SQLite блокировок строк нет, там это держится на единственном писателе.
+"""
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import DATABASE
+from .db import SessionLocal
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MEDIA_ROOT = os.path.abspath(os.getenv("MEDIA_ROOT", "media"))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(4 * 1024 ** 3)))
+USER_UPLOAD_QUOTA_BYTES = int(os.getenv("USER_UPLOAD_QUOTA_BYTES", str(10 * 1024 ** 3)))
+# Незавершённая загрузка без новых кусков дольше этого срока удаляется сборщиком мусора
+UPLOAD_SESSION_TTL_SECONDS = float(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600)))
+UPLOAD_GC_INTERVAL_SECONDS = float(os.getenv("UPLOAD_GC_INTERVAL_SECONDS", "3600"))
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+def upload_path(upload_uuid: str) -> str:
+    return os.path.join(MEDIA_ROOT, "uploads", f"{upload_uuid}.part")
+
+
+def file_path(sha256: str) -> str:
+    return os.path.join(MEDIA_ROOT, "files", sha256[:2], sha256[2:4], sha256)
+
+
+def poster_path(sha256: str) -> str:
+    return os.path.join(MEDIA_ROOT, "posters", sha256[:2], f"{sha256}.jpg")
+
+
+def create_partial(upload_uuid: str) -> None:
+    os.makedirs(os.path.dirname(upload_path(upload_uuid)), exist_ok=True)
+    open(upload_path(upload_uuid), "wb").close()
+
+
+def remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def upload_lock(upload_uuid: str):
+    """Один писатель на загрузку: параллельный PUT того же файла получает 409, а не портит его.
+
+    Файл блокировки удаляют только внутри этого блока. Кто успел открыть уже удалённый файл,
+    заметит после flock, что по пути лежит другой (или ничего), и откроет путь заново.
+    """
+    lock_path = upload_path(upload_uuid) + ".lock"
+    busy = HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Another request is writing this upload")
+
+    if fcntl is None:
+        with _local_locks_guard:
+            lock = _local_locks.setdefault(upload_uuid, threading.Lock())
+        if not lock.acquire(blocking=False):
+            raise busy
+        try:
+            yield
+        finally:
+            lock.release()
+        return
+
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    while True:
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise busy
+        if _same_file(fd, lock_path):
+            break
+        os.close(fd)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+def _same_file(fd: int, path: str) -> bool:
+    try:
+        current = os.stat(path)
+    except FileNotFoundError:
+        return False
+    opened = os.fstat(fd)
+    return (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino)
+
+
+def remove_upload_files(upload_uuid: str) -> None:
+    """Недописанный файл и файл блокировки. Вызывать внутри upload_lock(upload_uuid)."""
+    remove_quietly(upload_path(upload_uuid))
+    remove_quietly(upload_path(upload_uuid) + ".lock")
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def user_usage(db: Session, user_id: int) -> int:
+    """Занято пользователем: файлы его видео и завершённых загрузок плюс заявленный размер открытых загрузок."""
+    video_files = db.query(DATABASE.Video.file_id).filter(
+        DATABASE.Video.author_id == user_id, DATABASE.Video.file_id.isnot(None)
+    )
+    upload_files = db.query(DATABASE.UploadSession.file_id).filter(
+        DATABASE.UploadSession.user_id == user_id, DATABASE.UploadSession.file_id.isnot(None)
+    )
+    stored = db.query(func.coalesce(func.sum(DATABASE.StoredFile.size), 0)).filter(
+        DATABASE.StoredFile.id.in_(video_files.union(upload_files))
+    ).scalar()
+    pending = db.query(func.coalesce(func.sum(DATABASE.UploadSession.size), 0)).filter(
+        DATABASE.UploadSession.user_id == user_id, DATABASE.UploadSession.status == "uploading"
+    ).scalar()
+    return int(stored) + int(pending)
+
+
+def owns_file(db: Session, user_id: int, file_id: int) -> bool:
+    """Пользователь сам загрузил этот файл: есть его завершённая загрузка или видео с ним."""
+    upload = db.query(DATABASE.UploadSession.id).filter(
+        DATABASE.UploadSession.user_id == user_id,
+        DATABASE.UploadSession.file_id == file_id,
+        DATABASE.UploadSession.status == "completed"
+    )
+    video = db.query(DATABASE.Video.id).filter(DATABASE.Video.author_id == user_id, DATABASE.Video.file_id == file_id)
+    return db.query(upload.exists() | video.exists()).scalar()
+
+
+def check_quota(db: Session, user_id: int, size: int, counted: bool = False) -> None:
+    """counted — файл уже учтён в занятом пользователем (его собственный), квота от него не растёт."""
+    if size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File is too large")
+    if user_usage(db, user_id) + (0 if counted else size) > USER_UPLOAD_QUOTA_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Upload quota exceeded")
+
+
+def find_stored_file(db: Session, sha256: str) -> Optional[DATABASE.StoredFile]:
+    """Строка файла под FOR SHARE до commit вызывающего: сборщик мусора не удалит её, пока ссылка не записана."""
+    return db.query(DATABASE.StoredFile).filter(
+        DATABASE.StoredFile.sha256 == sha256
+    ).with_for_update(read=True).first()
+
+
+def store_file(db: Session, partial: str, sha256: str, size: int, content_type: str) -> DATABASE.StoredFile:
+    """Переносит готовый файл в хранилище или, если такое содержимое уже есть, переиспользует его.
+
+    Если содержимое уже есть, partial остаётся на месте: вызывающий удаляет его после commit ссылки.
+    """
+    existing = find_stored_file(db, sha256)
+    if existing is not None and os.path.exists(file_path(sha256)):
+        return existing
+
+    target = file_path(sha256)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(partial, target)
+    if existing is not None:
+        # Строка была, а файл пропал с диска — восстановили его этой загрузкой
+        return existing
+
+    stored = DATABASE.StoredFile(sha256=sha256, size=size, content_type=content_type)
+    db.add(stored)
+    try:
+        db.flush()
+    except IntegrityError:
+        # Такой же файл только что завершила параллельная загрузка: он уже лежит по тому же пути
+        db.rollback()
+        return find_stored_file(db, sha256)
+    return stored
+
+
+def collect_garbage(db: Session) -> dict:
+    """Удаляет брошенные загрузки и файлы, на которые больше ничего не ссылается."""
+    cutoff = datetime.utcnow() - timedelta(seconds=UPLOAD_SESSION_TTL_SECONDS)
+
+    abandoned = db.query(DATABASE.UploadSession).filter(DATABASE.UploadSession.updated_at < cutoff).all()
+    removed_sessions = 0
+    for session in abandoned:
+        try:
+            with upload_lock(session.uuid):
+                remove_upload_files(session.uuid)
+                db.delete(session)
+                db.commit()
+        except HTTPException:
+            # Загрузку прямо сейчас продолжают — значит, не брошена
+            db.rollback()
+            continue
+        removed_sessions += 1
+
+    referenced_by_videos = db.query(DATABASE.Video.file_id).filter(DATABASE.Video.file_id.isnot(None))
+    referenced_by_uploads = db.query(DATABASE.UploadSession.file_id).filter(DATABASE.UploadSession.file_id.isnot(None))
+    candidates = [file_id for (file_id,) in db.query(DATABASE.StoredFile.id).filter(
+        DATABASE.StoredFile.created_at < cutoff,
+        DATABASE.StoredFile.id.notin_(referenced_by_videos),
+        DATABASE.StoredFile.id.notin_(referenced_by_uploads)
+    ).all()]
+    db.rollback()
+    removed_files = sum(1 for file_id in candidates if _remove_orphan(db, file_id))
+
+    return {"sessions": removed_sessions, "files": removed_files}
+
+
+def _remove_orphan(db: Session, file_id: int) -> bool:
+    # Строку, которую сейчас переиспользуют (FOR SHARE), пропускаем до следующего прохода
+    stored = db.query(DATABASE.StoredFile).filter(
+        DATABASE.StoredFile.id == file_id
+    ).with_for_update(skip_locked=True).first()
+    if stored is None:
+        db.rollback()
+        return False
+
+    # Ссылки проверяем заново уже под блокировкой: кандидатов выбрали раньше
+    referenced = db.query(
+        db.query(DATABASE.Video.id).filter(DATABASE.Video.file_id == file_id).exists()
+        | db.query(DATABASE.UploadSession.id).filter(DATABASE.UploadSession.file_id == file_id).exists()
+    ).scalar()
+    if referenced:
+        db.rollback()
+        return False
+
+    db.delete(stored)
+    db.flush()
+    # Файл удаляем до commit, пока строка заблокирована: загрузка того же содержимого ждёт нас
+    # и после commit положит файл заново, а не получит его стёртым. Если commit сорвётся,
+    # останется строка без файла — store_file такую восстанавливает
+    remove_quietly(file_path(stored.sha256))
+    remove_quietly(poster_path(stored.sha256))
+    db.commit()
+    return True
+
+
+def collect_garbage_job() -> None:
+    db = SessionLocal()
+    try:
+        result = collect_garbage(db)
+        if result["sessions"] or result["files"]:
+            logger.info("Upload GC removed %(sessions)s sessions and %(files)s files", result)
+    finally:
+        db.close()
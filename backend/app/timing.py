@@ -0,0 +1,166 @@
+"""Разбивка времени запроса по фазам: заголовок Server-Timing и лог медленных запросов.
+
+Фазы не пересекаются:
+  auth      — get_current_user (проверка токена) без её SQL;
+  db        — весь SQL запроса, из querystats;
+  handler   — функция-обработчик без её SQL (маршруты с route_class=TimedRoute);
+  serialize — от возврата из обработчика до начала ответа: проверка response_model и JSON;
+  total     — до начала ответа. Остаток — разбор запроса, зависимости и middleware.
+
+Фазы считаются для доли запросов SERVER_TIMING_SAMPLE_RATE (по умолчанию ни для одного),
+у них в ответе есть Server-Timing. Медленный запрос (SLOW_REQUEST_MS) попадает в лог
+всегда, с фазами — если попал в выборку.
+"""
+import asyncio
+import functools
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from fastapi.routing import APIRoute
+from starlette.datastructures import MutableHeaders
+
+from . import querystats
+
+logger = logging.getLogger(__name__)
+
+SERVER_TIMING_SAMPLE_RATE = float(os.getenv("SERVER_TIMING_SAMPLE_RATE", "0"))
+# 0 — не логировать
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+
+PHASES = ("auth", "handler", "serialize")
+
+
+class Timing:
+    __slots__ = ("phases", "handler_finished", "handler_finished_sql")
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.handler_finished: Optional[float] = None
+        self.handler_finished_sql = 0.0
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+_current: ContextVar[Optional[Timing]] = ContextVar("request_timing", default=None)
+
+
+def _sql_seconds() -> float:
+    stats = querystats.current()
+    return stats.duration if stats is not None else 0.0
+
+
+@contextmanager
+def phase(name: str):
+    """Время блока без SQL внутри него — SQL уходит в фазу db. Вне выборки ничего не делает."""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    sql_started = _sql_seconds()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - started - (_sql_seconds() - sql_started))
+
+
+def _timed(endpoint):
+    # include_router пересоздаёт маршрут тем же классом: второй раз не оборачиваем
+    if getattr(endpoint, "_timed", False):
+        return endpoint
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            try:
+                with phase("handler"):
+                    return await endpoint(*args, **kwargs)
+            finally:
+                _mark_handler_finished()
+    else:
+        @functools.wraps(endpoint)
+        def timed_endpoint(*args, **kwargs):
+            try:
+                with phase("handler"):
+                    return endpoint(*args, **kwargs)
+            finally:
+                _mark_handler_finished()
+    timed_endpoint._timed = True
+    return timed_endpoint
+
+
+def _mark_handler_finished() -> None:
+    timing = _current.get()
+    if timing is not None:
+        timing.handler_finished = time.perf_counter()
+        timing.handler_finished_sql = _sql_seconds()
+
+
+class TimedRoute(APIRoute):
+    """Маршрут, который замеряет свой обработчик. Сигнатура сохраняется (functools.wraps) — зависимости не меняются."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _timed(endpoint), **kwargs)
+
+
+def server_timing(timing: Timing, total: float, stats: Optional[querystats.QueryStats]) -> str:
+    entries = [f"{name};dur={timing.phases[name] * 1000:.1f}" for name in PHASES if name in timing.phases]
+    if stats is not None:
+        entries.append(f'db;desc="{stats.count} queries";dur={stats.duration * 1000:.1f}')
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def log_slow_request(method: str, path: str, status: int, total: float, timing: Optional[Timing],
+                     stats: Optional[querystats.QueryStats]) -> None:
+    # Пары key=value одной строкой: удобно искать и разбирать сборщиком логов
+    fields = {"method": method, "route": path, "status": status, "total_ms": f"{total * 1000:.1f}"}
+    if stats is not None:
+        fields["db_ms"] = f"{stats.duration * 1000:.1f}"
+        fields["queries"] = stats.count
+    if timing is not None:
+        fields.update((f"{name}_ms", f"{timing.phases[name] * 1000:.1f}") for name in PHASES if name in timing.phases)
+    logger.warning("slow_request %s", " ".join(f"{key}={value}" for key, value in fields.items()))
+
+
+class ServerTimingMiddleware:
+    """Должен стоять внутри QueryStatsMiddleware: SQL берётся из её статистики."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (SERVER_TIMING_SAMPLE_RATE > 0 or SLOW_REQUEST_MS > 0):
+            return await self.app(scope, receive, send)
+
+        timing = Timing() if SERVER_TIMING_SAMPLE_RATE > 0 and random.random() < SERVER_TIMING_SAMPLE_RATE else None
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if timing is not None:
+                    now = time.perf_counter()
+                    if timing.handler_finished is not None:
+                        timing.add("serialize", now - timing.handler_finished
+                                   - (_sql_seconds() - timing.handler_finished_sql))
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", server_timing(timing, now - started, querystats.current()))
+            await send(message)
+
+        token = _current.set(timing)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            total = time.perf_counter() - started
+            if SLOW_REQUEST_MS > 0 and total * 1000 >= SLOW_REQUEST_MS:
+                log_slow_request(scope["method"], querystats.route_path(scope), status, total, timing,
+                                 querystats.current())
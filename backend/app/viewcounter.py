@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+from collections import Counter
+
+from sqlalchemy import bindparam, func
+
+from . import DATABASE
+from .background import PeriodicTask
+from .db import engine
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд просмотров может потеряться при аварийном падении процесса
+VIEW_FLUSH_INTERVAL_SECONDS = float(os.getenv("VIEW_FLUSH_INTERVAL_SECONDS", "5"))
+# При таком числе накопленных просмотров сброс происходит раньше срока
+VIEW_FLUSH_MAX_PENDING = int(os.getenv("VIEW_FLUSH_MAX_PENDING", "1000"))
+
+
+class ViewCounter:
+    """Копит просмотры в памяти и пишет их одним пакетным UPDATE views_count = views_count + n."""
+
+    def __init__(self, flush_interval: float, max_pending: int):
+        self.max_pending = max_pending
+        self._pending = Counter()
+        self._total = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._task = PeriodicTask("view-counter-flush", flush_interval, self.flush)
+
+    def add(self, video_id: int) -> None:
+        with self._lock:
+            self._pending[video_id] += 1
+            self._total += 1
+            full = self._total >= self.max_pending
+        if full:
+            self._task.trigger()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, Counter()
+                self._total = 0
+            if not batch:
+                return 0
+
+            videos = DATABASE.Video.__table__
+            statement = (
+                videos.update()
+                .where(videos.c.id == bindparam("video_id"))
+                .values(views_count=func.coalesce(videos.c.views_count, 0) + bindparam("views"))
+            )
+            try:
+                with engine.begin() as conn:
+                    conn.execute(statement, [
+                        {"video_id": video_id, "views": views} for video_id, views in batch.items()
+                    ])
+            except Exception:
+                # Не теряем просмотры при временной ошибке БД — вернём их в буфер до следующей попытки
+                with self._lock:
+                    self._pending.update(batch)
+                    self._total += sum(batch.values())
+                raise
+            return len(batch)
+
+    def start(self) -> None:
+        self._task.start()
+
+    def stop(self) -> None:
+        self._task.stop()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Final view counter flush failed")
+
+
+view_counter = ViewCounter(VIEW_FLUSH_INTERVAL_SECONDS, VIEW_FLUSH_MAX_PENDING)
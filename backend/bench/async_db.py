@@ -0,0 +1,152 @@
+"""Пропускная способность горячих эндпоинтов: AsyncSession против сессии в пуле потоков.
+
+    python bench/async_db.py --clients 16 64 256 --seconds 10
+
+Для каждого режима (DATABASE_ASYNC=1 — async-драйвер, 0 — обычная сессия в пуле потоков)
+поднимает uvicorn отдельным процессом на одной и той же временной SQLite-базе и гоняет
+clients одновременных клиентов по каталогу, комментариям и письмам (с авторизацией).
+Кэши ответов и токенов выключены, чтобы каждый запрос доходил до БД.
+Нужен aiosqlite (для Postgres — asyncpg и --database-url).
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND)
+
+import httpx
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, database_url: str, async_mode: bool) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "DATABASE_ASYNC": "1" if async_mode else "0",
+        "RESPONSE_CACHE_TTL_SECONDS": "0",
+        "TOKEN_CACHE_TTL_SECONDS": "0",
+        "TOKEN_PURGE_INTERVAL_SECONDS": "0",
+        "UPLOAD_GC_INTERVAL_SECONDS": "0",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:dwfu", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND, env=env
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def login(client: httpx.Client, name: str) -> dict:
+    # Без SECRET_KEY в окружении каждый процесс сервера подписывает токены своим ключом: входим заново
+    client.post("/api/users/register", json={"email": f"{name}@example.com", "username": name, "password": "secret1"})
+    token = client.post("/api/users/auth/login", json={"email": f"{name}@example.com",
+                                                       "password": "secret1"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def seed(base: str, videos: int) -> dict:
+    with httpx.Client(base_url=base, timeout=60) as client:
+        headers = [login(client, name) for name in ("bench_a", "bench_b")]
+
+        body = "".join(
+            f'{{"title": "bench {i}", "video_url": "https://cdn.example.com/{i}.mp4"}}\n' for i in range(videos)
+        )
+        client.post("/api/video/import/bulk", content=body, headers=headers[0])
+        video_id = client.get("/api/video/", params={"limit": 1}).json()[0]["id"]
+        for i in range(50):
+            client.post(f"/api/video/{video_id}/comments/create_comment", json={"content": f"c{i}"},
+                        headers=headers[i % 2])
+
+        other_id = client.get("/api/users/auth/me", headers=headers[1]).json()["id"]
+        chat_id = client.get(f"/api/chats/with/{other_id}", headers=headers[0]).json()["id"]
+        for i in range(50):
+            client.post(f"/api/chats/{chat_id}/letters/", json={"content": f"m{i}"}, headers=headers[i % 2])
+
+    return {"headers": headers[0], "video_id": video_id, "chat_id": chat_id, "videos": videos}
+
+
+ENDPOINTS = {
+    "catalog": lambda data, rng: ("/api/video/", {"skip": rng.randrange(0, data["videos"] - 20), "limit": 20}, None),
+    "comments": lambda data, rng: (f"/api/video/{data['video_id']}/comments/", {"limit": 20}, None),
+    "letters": lambda data, rng: (f"/api/chats/{data['chat_id']}/letters/", {"limit": 20}, data["headers"]),
+}
+
+
+async def run_load(base: str, data: dict, endpoints: list, clients: int, seconds: float) -> tuple:
+    requests = [ENDPOINTS[name] for name in endpoints]
+    latencies = []
+    statuses = {}
+    deadline = time.perf_counter() + seconds
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+
+    async with httpx.AsyncClient(base_url=base, timeout=60, limits=limits) as client:
+        async def worker(seed_value: int):
+            rng = random.Random(seed_value)
+            while time.perf_counter() < deadline:
+                path, params, headers = rng.choice(requests)(data, rng)
+                started = time.perf_counter()
+                response = await client.get(path, params=params, headers=headers)
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(clients)))
+        elapsed = time.perf_counter() - started
+    return latencies, statuses, elapsed
+
+
+def report(name: str, clients: int, latencies: list, statuses: dict, elapsed: float) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+    print(f"{name:>8} clients={clients:4d}: {len(latencies) / elapsed:8.1f} req/s  "
+          f"p50={statistics.median(latencies):8.2f} ms  p99={p99:8.2f} ms  statuses={statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--videos", type=int, default=2000)
+    parser.add_argument("--endpoints", nargs="+", choices=sorted(ENDPOINTS), default=sorted(ENDPOINTS))
+    parser.add_argument("--database-url", default=f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    args = parser.parse_args()
+
+    data = None
+    for name, async_mode in (("async", True), ("threaded", False)):
+        port = free_port()
+        server = start_server(port, args.database_url, async_mode)
+        base = f"http://127.0.0.1:{port}"
+        try:
+            if data is None:
+                data = seed(base, args.videos)
+            with httpx.Client(base_url=base, timeout=60) as client:
+                data["headers"] = login(client, "bench_a")
+            for clients in args.clients:
+                report(name, clients, *asyncio.run(run_load(base, data, args.endpoints, clients, args.seconds)))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Задержка чтения каталога во время шквала логинов.
+
+    python bench/login_storm.py --storm-threads 64 --seconds 10
+
+Поднимает приложение на временной SQLite-базе, замеряет GET /api/video/ в покое
+и пока storm-threads потоков без остановки вызывают /api/users/auth/login.
+С отдельным пулом для bcrypt задержка каталога должна оставаться примерно такой же,
+а лишние логины получают 503.
+"""
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+import httpx
+import uvicorn
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int) -> uvicorn.Server:
+    from app.main import dwfu
+
+    server = uvicorn.Server(uvicorn.Config(dwfu, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def measure_catalog(base: str, seconds: float) -> list:
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    with httpx.Client(base_url=base, timeout=60) as client:
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            client.get("/api/video/", params={"limit": 20})
+            latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:>14}: n={len(latencies):5d}  p50={statistics.median(latencies):7.2f} ms  p95={p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--storm-threads", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    port = free_port()
+    server = start_server(port)
+    base = f"http://127.0.0.1:{port}"
+
+    with httpx.Client(base_url=base) as client:
+        client.post("/api/users/register", json={"email": "bench@example.com", "username": "bench", "password": "benchmark"})
+        token = client.post("/api/users/auth/login", json={"email": "bench@example.com", "password": "benchmark"}).json()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        for i in range(50):
+            client.post("/api/video/import", headers=headers, json={"title": f"video {i}", "video_url": f"https://example.com/{i}.mp4"})
+
+    report("idle", measure_catalog(base, args.seconds / 2))
+
+    stop = threading.Event()
+    statuses = {}
+    lock = threading.Lock()
+
+    def storm():
+        with httpx.Client(base_url=base, timeout=60) as client:
+            while not stop.is_set():
+                status = client.post("/api/users/auth/login", json={"email": "bench@example.com", "password": "benchmark"}).status_code
+                with lock:
+                    statuses[status] = statuses.get(status, 0) + 1
+                if status == 503:
+                    # Клиент соблюдает Retry-After, но с коротким интервалом, чтобы давление оставалось высоким
+                    time.sleep(0.1)
+
+    threads = [threading.Thread(target=storm, daemon=True) for _ in range(args.storm_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    report("login storm", measure_catalog(base, args.seconds))
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print("login statuses:", statuses)
+    with httpx.Client(base_url=base) as client:
+        print("password hashing:", client.get("/stats").json()["password_hashing"])
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Пропускная способность стриминга при одновременной перемотке.
+
+    python bench/stream_seek.py --seekers 32 --file-mb 256 --range-kb 512 --seconds 10
+
+Поднимает приложение на временной SQLite-базе и MEDIA_ROOT, кладёт в хранилище файл
+случайного содержимого и запускает seekers потоков, каждый из которых запрашивает
+случайный Range размером range-kb. Перемотка должна стоить порядка одного чтения range-kb,
+а не скачивания файла: время ответа не зависит от --file-mb. Для сравнения в конце
+замеряется одно скачивание файла целиком. --chunk-size-kb задаёт STREAM_CHUNK_SIZE.
+"""
+import argparse
+import hashlib
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+os.environ.setdefault("MEDIA_ROOT", tempfile.mkdtemp())
+
+import httpx
+import uvicorn
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int) -> uvicorn.Server:
+    from app.main import dwfu
+
+    server = uvicorn.Server(uvicorn.Config(dwfu, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def create_video(file_mb: int) -> str:
+    """Кладёт файл прямо в хранилище, минуя /api/uploads: бенчмарк меряет только отдачу."""
+    from app import DATABASE, storage
+    from app.db import SessionLocal
+
+    digest = hashlib.sha256()
+    partial = os.path.join(storage.MEDIA_ROOT, "bench.part")
+    with open(partial, "wb") as f:
+        for _ in range(file_mb):
+            block = os.urandom(1024 * 1024)
+            digest.update(block)
+            f.write(block)
+
+    db = SessionLocal()
+    try:
+        user = DATABASE.User(email="bench@example.com", username="bench", hashed_password="-")
+        db.add(user)
+        db.flush()
+        stored = storage.store_file(db, partial, digest.hexdigest(), file_mb * 1024 * 1024, "video/mp4")
+        video = DATABASE.Video(uuid="bench", title="bench", video_url="/api/video/bench/stream",
+                               author_id=user.id, file_id=stored.id)
+        db.add(video)
+        db.commit()
+    finally:
+        db.close()
+    return "/api/video/bench/stream"
+
+
+def report(name: str, latencies: list, total_bytes: int, seconds: float) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:>10}: n={len(latencies):6d}  {len(latencies) / seconds:8.1f} req/s  "
+          f"{total_bytes / seconds / 1024 ** 2:8.1f} MB/s  "
+          f"p50={statistics.median(latencies):7.2f} ms  p95={p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seekers", type=int, default=32)
+    parser.add_argument("--file-mb", type=int, default=256)
+    parser.add_argument("--range-kb", type=int, default=512)
+    parser.add_argument("--chunk-size-kb", type=int, default=None)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    if args.chunk_size_kb:
+        os.environ["STREAM_CHUNK_SIZE"] = str(args.chunk_size_kb * 1024)
+
+    port = free_port()
+    server = start_server(port)
+    base = f"http://127.0.0.1:{port}"
+    url = create_video(args.file_mb)
+    file_size = args.file_mb * 1024 * 1024
+    range_size = args.range_kb * 1024
+
+    latencies = []
+    transferred = [0]
+    statuses = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def seeker():
+        rng = random.Random()
+        with httpx.Client(base_url=base, timeout=60) as client:
+            while not stop.is_set():
+                start = rng.randrange(0, file_size - range_size)
+                started = time.perf_counter()
+                response = client.get(url, headers={"Range": f"bytes={start}-{start + range_size - 1}"})
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    transferred[0] += len(response.content)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=seeker, daemon=True) for _ in range(args.seekers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    report("seek", latencies, transferred[0], time.perf_counter() - started)
+    print("statuses:", statuses)
+
+    with httpx.Client(base_url=base, timeout=300) as client:
+        started = time.perf_counter()
+        size = 0
+        with client.stream("GET", url) as response:
+            for block in response.iter_bytes():
+                size += len(block)
+        elapsed = time.perf_counter() - started
+        report("full file", [elapsed * 1000], size, elapsed)
+
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+# До импорта приложения: настройки читаются при импорте модулей
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/test.db")
+os.environ.setdefault("MEDIA_ROOT", os.path.join(_tmp, "media"))
+# Без кэшей: иначе повторный запрос в тесте не дойдёт до БД и бюджет ничего не проверит
+os.environ.setdefault("RESPONSE_CACHE_TTL_SECONDS", "0")
+os.environ.setdefault("TOKEN_CACHE_TTL_SECONDS", "0")
+os.environ.setdefault("TOKEN_PURGE_INTERVAL_SECONDS", "0")
+os.environ.setdefault("UPLOAD_GC_INTERVAL_SECONDS", "0")
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import dwfu
+from app.querystats import assert_max_queries
+
+
+@pytest.fixture(scope="session")
+def client():
+    # Один event loop на все запросы, как под uvicorn: asyncpg привязывает к нему соединения
+    with TestClient(dwfu) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def register(client):
+    def register(name: str) -> dict:
+        client.post("/api/users/register",
+                    json={"email": f"{name}@example.com", "username": name, "password": "secret1"})
+        tokens = client.post("/api/users/auth/login",
+                             json={"email": f"{name}@example.com", "password": "secret1"}).json()
+        me = client.get("/api/users/auth/me", headers={"Authorization": f"Bearer {tokens['access_token']}"}).json()
+        return {"id": me["id"], "headers": {"Authorization": f"Bearer {tokens['access_token']}"}}
+    return register
+
+
+@pytest.fixture
+def query_budget():
+    """with query_budget(3): client.get(...) — не больше трёх SQL-запросов, считая аутентификацию."""
+    return assert_max_queries
@@ -0,0 +1,25 @@
+"""Кэш проверенных токенов и отзыв."""
+from app import authLOGIK
+from app.authLOGIK import token_cache
+
+
+def login(client, name: str) -> dict:
+    client.post("/api/users/register",
+                json={"email": f"{name}@example.com", "username": name, "password": "secret1"})
+    return client.post("/api/users/auth/login", json={"email": f"{name}@example.com", "password": "secret1"}).json()
+
+
+def test_logout_drops_cached_token(client, monkeypatch):
+    # В остальных тестах кэш выключен (conftest), здесь он нужен
+    monkeypatch.setattr(authLOGIK, "TOKEN_CACHE_TTL_SECONDS", 30.0)
+    tokens = login(client, "cache_user")
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+    assert client.get("/api/users/auth/me", headers=headers).status_code == 200
+    size = token_cache.stats()["size"]
+    assert size >= 1
+
+    client.post("/api/users/auth/logout", json={"refresh_token": tokens["refresh_token"]})
+    # Отзыв снимает запись из кэша, и ничего на пользователя после себя не оставляет
+    assert token_cache.stats()["size"] == size - 1
+    assert client.get("/api/users/auth/me", headers=headers).status_code == 401
@@ -0,0 +1,18 @@
+"""Импорт видео по ссылке."""
+
+
+def test_repeated_import_returns_the_same_video(client, register):
+    author = register("import_author")
+    payload = {"title": "talk", "video_url": "https://example.com/talks/1?b=2&a=1"}
+
+    created = client.post("/api/video/import", headers=author["headers"], json=payload)
+    assert created.status_code == 201
+
+    # Та же ссылка после нормализации — не ошибка и не второе видео
+    again = client.post("/api/video/import", headers=author["headers"],
+                        json={**payload, "video_url": "https://EXAMPLE.com:443/talks/1?a=1&b=2"})
+    assert again.status_code == 200
+    assert again.json()["id"] == created.json()["id"]
+
+    documented = client.get("/openapi.json").json()["paths"]["/api/video/import"]["post"]["responses"]
+    assert {"200", "201"} <= documented.keys()
@@ -0,0 +1,20 @@
+"""Счётчик непрочитанных по отметке last_read_letter_id."""
+
+
+def test_unread_count_survives_deleting_the_newest_letter(client, register):
+    alice, bob = register("inbox_alice"), register("inbox_bob")
+    chat_id = client.get(f"/api/chats/with/{bob['id']}", headers=alice["headers"]).json()["id"]
+    letters = f"/api/chats/{chat_id}/letters/"
+
+    client.post(letters, headers=alice["headers"], json={"content": "first"})
+    newest = client.post(letters, headers=alice["headers"], json={"content": "second"}).json()["id"]
+    client.post(f"/api/chats/{chat_id}/read", headers=bob["headers"])
+
+    # id удалённого последнего письма не должен достаться новому: иначе оно сразу "прочитано"
+    client.delete(f"{letters}{newest}", headers=alice["headers"])
+    resent = client.post(letters, headers=alice["headers"], json={"content": "again"}).json()["id"]
+    assert resent > newest
+    assert client.get("/api/chats/unread/count", headers=bob["headers"]).json() == 1
+
+    client.delete(f"{letters}{resent}", headers=alice["headers"])
+    assert client.get("/api/chats/unread/count", headers=bob["headers"]).json() == 0
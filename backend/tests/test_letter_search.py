@@ -0,0 +1,31 @@
+"""Поиск по письмам: курсор проходит все результаты без пропусков и повторов."""
+
+
+def test_search_cursor_walks_every_match_once(client, register):
+    alice, bob = register("search_alice"), register("search_bob")
+    chat_id = client.get(f"/api/chats/with/{bob['id']}", headers=alice["headers"]).json()["id"]
+
+    # Разная длина и число повторов — разный rank; одинаковые письма дают равный rank, порядок решает id
+    contents = [("rocket " * (1 + i % 4)) + "filler " * (i % 5) for i in range(23)]
+    created = {
+        client.post(f"/api/chats/{chat_id}/letters/", headers=alice["headers"], json={"content": content}).json()["id"]
+        for content in contents
+    }
+
+    seen, cursor = [], None
+    # С запасом на одну лишнюю страницу; зацикленный курсор упадёт здесь, а не повесит тест
+    for _ in range(len(created) // 4 + 2):
+        params = {"q": "rocket", "limit": 4}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/api/chats/search", headers=bob["headers"], params=params)
+        assert response.status_code == 200
+        seen.extend(row["id"] for row in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    else:
+        raise AssertionError(f"cursor did not finish, seen {len(seen)} rows")
+
+    assert len(seen) == len(set(seen))
+    assert set(seen) == created
@@ -0,0 +1,84 @@
+"""Бюджеты SQL-запросов на страницу списка: число не должно расти с количеством строк (N+1)."""
+import threading
+
+import pytest
+
+from app.viewcounter import view_counter
+
+# get_current_user с выключенным кэшем токенов: строка токена и пользователь
+AUTH = 2
+
+
+@pytest.fixture(scope="module")
+def data(client, register):
+    authors = [register(f"author{i}") for i in range(5)]
+    reader = register("reader")
+
+    videos = [
+        client.post("/api/video/import", headers=author["headers"],
+                    json={"title": f"video {i}", "video_url": f"https://example.com/{i}"}).json()["id"]
+        for i, author in enumerate(authors)
+    ]
+    for author in authors:
+        client.post(f"/api/video/{videos[0]}/comments/create_comment", headers=author["headers"],
+                    json={"content": "comment"})
+
+    chats = []
+    for author in authors:
+        chat_id = client.get(f"/api/chats/with/{author['id']}", headers=reader["headers"]).json()["id"]
+        for sender in (reader, author, reader):
+            client.post(f"/api/chats/{chat_id}/letters/", headers=sender["headers"], json={"content": "hello"})
+        chats.append(chat_id)
+
+    for video_id in videos:
+        client.post(f"/api/video/{video_id}/watch", headers=reader["headers"],
+                    json={"video_id": video_id, "watch_duration": 10})
+
+    return {"reader": reader, "videos": videos, "chats": chats}
+
+
+def test_catalog(client, data, query_budget):
+    with query_budget(2):
+        response = client.get("/api/video/")
+    assert response.status_code == 200
+    # База общая на все тесты: проверяем, что видео модуля на странице, а не их точное число
+    assert set(data["videos"]) <= {video["id"] for video in response.json()}
+
+
+def test_comments(client, data, query_budget):
+    with query_budget(3):
+        response = client.get(f"/api/video/{data['videos'][0]}/comments/")
+    assert response.status_code == 200
+    assert len({comment["author_id"] for comment in response.json()}) == 5
+
+
+def test_chat_letters(client, data, query_budget):
+    with query_budget(AUTH + 7):
+        response = client.get(f"/api/chats/{data['chats'][0]}/letters/", headers=data["reader"]["headers"])
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+
+
+def test_inbox(client, data, query_budget):
+    with query_budget(AUTH + 1):
+        response = client.get("/api/chats/my", headers=data["reader"]["headers"])
+    assert response.status_code == 200
+    assert len(response.json()) == len(data["chats"])
+
+
+def test_history(client, data, query_budget):
+    reader = data["reader"]
+    with query_budget(AUTH + 2):
+        response = client.get(f"/api/users/{reader['id']}/history", headers=reader["headers"])
+    assert response.status_code == 200
+    assert len(response.json()) == len(data["videos"])
+
+
+def test_budget_ignores_background_threads(data, query_budget):
+    # Сброс просмотров идёт в своём потоке, без контекста теста, и в бюджет не входит
+    with query_budget(0) as stats:
+        view_counter.add(data["videos"][0])
+        flush = threading.Thread(target=view_counter.flush)
+        flush.start()
+        flush.join()
+    assert stats.count == 0